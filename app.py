@@ -1,17 +1,23 @@
+import json
 from flask import Flask, render_template, request, redirect, jsonify, url_for, render_template_string
-from optimization import *
-from plotting import *
+from flask import Response, abort
 from rq import Queue
 from rq.job import Job
 from worker import conn
-q = Queue(connection=conn)
+from rq.exceptions import NoSuchJobError
+from jobs import submit_portfolio, submit_batch, batch_jobs, batch_status, job_queue
+from jobs import validate_batch
+from results import get_result_store, LocalResultStore, unpack_result
+from metrics import timer, render_metrics
+from worker import listen
+from rq import Worker
+queues = {name: Queue(name, connection=conn) for name in listen}
 
 app = Flask(__name__)
-portfolio = {}
-optimization_results = []
-histories = []
-df_stat = []
-Selected_idx = [-1]
+# optimization results by job id
+result_store = get_result_store(conn)
+# rendered Bokeh components by (job id, "static") and (job id, solution index)
+render_store = LocalResultStore(max_bytes=64 * 1024 * 1024)
 
 
 @app.route("/Home", methods=["GET", "POST"])
@@ -21,152 +27,320 @@ def index():
         return render_template("Home.html")
     else:
         userInputs = []
-        Selected_idx = [-1]
+        portfolio = {}
         form = request.form
         for key, value in form.items():
             if key.startswith("cell"):
                 userInputs.append(value)
-        portfolio.clear()
         for i in range(0, len(userInputs), 2):
             portfolio[userInputs[i].strip()] = int(userInputs[i + 1].strip())
-        # perform optimization
-        job = q.enqueue(process_portfolio, portfolio)
+        # perform optimization, reusing an identical queued, running or cached job,
+        # on the queue matching its size
+        # CVaR of the historical daily returns as a third objective if asked
+        options = {}
+        if form.get("cvar"):
+            options["cvar"] = "historical"
+        q = queues[job_queue(len(portfolio))]
+        job = submit_portfolio(q, "optimization.process_portfolio", portfolio, **options)
+        if job.get_status() == 'finished':
+            return redirect(url_for('Results', id=job.id))
         return redirect(url_for('progress', id=job.id)) # this page will show 
 
 
+def load_results(job):
+    """
+    Store the results of a finished job in the result store. Packed results
+    become dicts of numpy arrays, with histories read from the price store.
+    """
+    if isinstance(job.result, tuple):
+        # pickled frames of a job that finished before results were packed
+        (tmp, stk_hst, df_st) = job.result
+        results = {
+            # keep the stock order of the job that produced the results
+            "portfolio": job.args[0],
+            "output": tmp,
+            "histories": stk_hst,
+            "df_stat": df_st,
+        }
+    else:
+        results = unpack_result(job.result)
+        tickers = results["portfolio"]["tickers"].tolist()
+        results["portfolio"] = dict(
+            zip(tickers, results["portfolio"]["quantities"].tolist())
+        )
+        if "history_refs" in results:
+            from prices import history_records
+
+            refs = results.pop("history_refs")
+            results["histories"] = {
+                t: history_records(t, *refs[str(i)]) for i, t in enumerate(tickers)
+            }
+        else:
+            results["histories"] = {
+                t: results["histories"][str(i)] for i, t in enumerate(tickers)
+            }
+    result_store.put(job.id, results)
+    return results
+
+
+def get_results(id):
+    """
+    Results of job id, loaded from the finished job if they are not stored
+    """
+    results = result_store.get(id)
+    if results is None:
+        try:
+            job = Job.fetch(id, connection=conn)
+        except NoSuchJobError:
+            return None
+        if job.get_status() != 'finished':
+            return None
+        results = load_results(job)
+    return results
+
+
 @app.route('/progress/<string:id>')
 def progress(id):
     job = Job.fetch(id, connection=conn)
     status = job.get_status()
     if status in ['queued', 'started', 'deferred']:
-        return render_template("Redirect.html", refresh=True)
+        return render_template("Redirect.html", refresh=True, id=id)
     elif status in ['failed']:
         return render_template("Failure.html")
     elif status == 'finished':
-        (tmp, stk_hst, df_st) = job.result 
-        optimization_results.append(tmp)
-        # print(optimization_results)
-        histories.append(stk_hst)
-        df_stat.append(df_st)
-        return redirect(url_for('Results')) # this page will show 
+        return redirect(url_for('Results', id=id)) # this page will show 
     
 
-@app.route("/Results", methods=["GET", "POST"])
-def Results():
-    if request.method == "GET":
-        out = optimization_results[-1]
-        if len(Selected_idx) == 1:
-            idx = -1
-        else:
-            idx = Selected_idx.pop()
-        df, unformatted_df = Solutions(
-            out["df_res"],
-            out["X"],
-            portfolio,
-            out["allocation"],
-            out["allocated_weights"],
-            idx,
-        )
+def job_status(job):
+    """
+    Compact status of a job: stage and percent complete as reported by the
+    worker, and the page to go to once the job is done
+    """
+    status = job.get_status()
+    data = {
+        "status": status,
+        "stage": job.meta.get("stage"),
+        "percent": job.meta.get("percent", 0),
+        "progress": job.meta.get("progress"),
+    }
+    if status == 'finished':
+        data["percent"] = 100
+        data["url"] = url_for('Results', id=job.id)
+    elif status == 'failed':
+        data["url"] = url_for('progress', id=job.id)
+    return data
 
-        # add optimization plot to the Results page
-        plot = plotPareto(
-            out["df_mc"], out["df_res"], out["exp_vol"], out["exp_ret"], idx
-        )
-        plot.sizing_mode = "scale_width"
-        plot_script, plot_div = components(plot)
-
-        # add weights plot to the page
-        w_plot = plotWeights(unformatted_df, idx)
-        w_plot.sizing_mode = "scale_width"
-        w_plot_script, w_plot_div = components(w_plot)
-
-        # add stock price history layout plot
-        stocks_histories = histories[-1]
-        # print(stocks_histories.keys())
-        n_layout = get_layout(stocks_histories)
-        n_layout_script, n_layout_div = components(n_layout)
-
-        # add plot of expected returns and expected volitilities for stocks in the portfolio
-        df_statistics = df_stat[-1]
-        e_plot = plotEvEr(df_statistics)
-        e_plot.sizing_mode = "scale_width"
-        e_plot_script, e_plot_div = components(e_plot)
-
-        kwargs = {
-            "plot_script": plot_script,
-            "plot_div": plot_div,
-            "w_plot_script": w_plot_script,
-            "w_plot_div": w_plot_div,
+
+def fetch_job(id):
+    try:
+        return Job.fetch(id, connection=conn)
+    except NoSuchJobError:
+        abort(404)
+
+
+@app.route('/progress/<string:id>/status')
+def progress_status(id):
+    """
+    Status of a job, polled by the progress page. It answers at once: gunicorn
+    runs synchronous workers, so a request held open would block a worker.
+    """
+    return jsonify(job_status(fetch_job(id)))
+
+
+def render_static(id, results):
+    """
+    Components that do not depend on the selected solution, rendered once per job
+    """
+    rendered = render_store.get((id, "static"))
+    if rendered is None:
+        # bokeh is imported on the first render, not when the web worker boots
+        from bokeh.embed import components
+        from plotting import get_layout, plotEvEr
+
+        with timer("render_static", conn=conn):
+            # add stock price history layout plot
+            stocks_histories = results["histories"]
+            url = url_for("history", id=id, ticker="__ticker__")
+            n_layout = get_layout(stocks_histories, url=url)
+            n_layout_script, n_layout_div = components(n_layout)
+
+            # add plot of expected returns and expected volitilities for stocks in the portfolio
+            df_statistics = results["df_stat"]
+            e_plot = plotEvEr(df_statistics, stocks=list(results["portfolio"]))
+            e_plot.sizing_mode = "scale_width"
+            e_plot_script, e_plot_div = components(e_plot)
+
+        rendered = {
             "n_layout_script": n_layout_script,
             "n_layout_div": n_layout_div,
             "e_plot_script": e_plot_script,
             "e_plot_div": e_plot_div,
         }
+        render_store.put((id, "static"), rendered)
+    return rendered
 
-        kwargs["title"] = ""
-        # add data frame data to the Results page
-        kwargs["tables"] = [df.to_html(classes="data")]
-        kwargs["titles"] = df.columns.values
-        kwargs["row_data"] = list(df.values.tolist())
-        kwargs["text_selected"] = idx
 
-        return render_template("Results.html", **kwargs)
-    else:
-        Selected_idx.append(int(request.form["pareto_idx"].strip()))
-        out = optimization_results[-1]
-        idx = Selected_idx.pop()
-        df, unformatted_df = Solutions(
-            out["df_res"],
-            out["X"],
-            portfolio,
-            out["allocation"],
-            out["allocated_weights"],
-            idx,
-        )
-        # add optimization plot to the Results page
-        plot = plotPareto(
-            out["df_mc"], out["df_res"], out["exp_vol"], out["exp_ret"], idx
-        )
-        plot.sizing_mode = "scale_width"
-        plot_script, plot_div = components(plot)
-
-        # add weights plot to the page
-        w_plot = plotWeights(unformatted_df, idx)
-        w_plot.sizing_mode = "scale_width"
-        w_plot_script, w_plot_div = components(w_plot)
-
-        # add stock price history layout plot
-        stocks_histories = histories[-1]
-        n_layout = get_layout(stocks_histories)
-        n_layout_script, n_layout_div = components(n_layout)
-
-        # add plot of expected returns and expected volitilities for stocks in the portfolio
-        df_statistics = df_stat[-1]
-        e_plot = plotEvEr(df_statistics)
-        e_plot.sizing_mode = "scale_width"
-        e_plot_script, e_plot_div = components(e_plot)
-
-        kwargs = {
+def render_selection(id, results, idx):
+    """
+    Components of the Pareto solution idx, rendered once per (job, idx)
+    """
+    rendered = render_store.get((id, idx))
+    if rendered is None:
+        from bokeh.embed import components
+        from plotting import plotPareto, plotWeights
+        from solutions import Solutions
+
+        with timer("render_selection", conn=conn):
+            out = results["output"]
+            df, unformatted_df = Solutions(
+                out["df_res"],
+                # results packed before empty Pareto sets were kept have no X
+                out.get("X"),
+                results["portfolio"],
+                out["allocation"],
+                out["allocated_weights"],
+                idx,
+            )
+
+            # add optimization plot to the Results page
+            plot = plotPareto(
+                out["df_mc"], out["df_res"], out["exp_vol"], out["exp_ret"], idx
+            )
+            plot.sizing_mode = "scale_width"
+            plot_script, plot_div = components(plot)
+
+            # add weights plot to the page
+            w_plot = plotWeights(unformatted_df, idx)
+            w_plot.sizing_mode = "scale_width"
+            w_plot_script, w_plot_div = components(w_plot)
+
+        rendered = {
             "plot_script": plot_script,
             "plot_div": plot_div,
             "w_plot_script": w_plot_script,
             "w_plot_div": w_plot_div,
-            "n_layout_script": n_layout_script,
-            "n_layout_div": n_layout_div,
-            "e_plot_script": e_plot_script,
-            "e_plot_div": e_plot_div,
+            # add data frame data to the Results page
+            "tables": [df.to_html(classes="data")],
+            "titles": df.columns.values,
+            "row_data": list(df.values.tolist()),
+        }
+        render_store.put((id, idx), rendered)
+    return rendered
+
+
+@app.route("/Results/<string:id>", methods=["GET", "POST"])
+def Results(id):
+    results = get_results(id)
+    if results is None:
+        return redirect(url_for("index"))
+    if request.method == "GET":
+        idx = -1
+    else:
+        from solutions import select_solution
+
+        try:
+            idx = select_solution(
+                results["output"]["df_res"], request.form["pareto_idx"].strip()
+            )
+        except (ValueError, IndexError):
+            idx = -1
+
+    kwargs = {}
+    kwargs.update(render_selection(id, results, idx))
+    kwargs.update(render_static(id, results))
+    # min_cvar is only offered when CVaR was an objective
+    kwargs["has_cvar"] = "CVaR" in results["output"]["df_res"]
+    kwargs["title"] = ""
+    kwargs["job_id"] = id
+    kwargs[
+        "text_selected"
+    ] = idx  # f'Index of currently selected solution is {idx} and this point is shown in the below graph with a blue circle'
+
+    return render_template("Results.html", **kwargs)
+
+
+@app.route("/Results/<string:id>/history/<string:ticker>")
+def history(id, ticker):
+    """
+    Chart columns of the price history of one ticker of job id, fetched by
+    the ticker selector of the Results page
+    """
+    from plotting import MAX_POINTS, history_columns
+
+    results = get_results(id)
+    if results is None or ticker not in results["histories"]:
+        abort(404)
+    max_points = request.args.get("max_points", MAX_POINTS, type=int)
+    columns = history_columns(results["histories"][ticker], max_points)
+    return jsonify(
+        {
+            part: {name: values.tolist() for name, values in data.items()}
+            for part, data in columns.items()
         }
+    )
+
+
+def batch_response(batch_id, job_ids, first=None):
+    """
+    NDJSON results of a batch, one line per portfolio that has finished so
+    far. The batch API is polled: while jobs run, a last "pending" line
+    gives the URL to request again, which repeats the results already sent.
+    """
+    lines = [] if first is None else [first]
+    for data in batch_status(conn, job_ids):
+        if data["status"] == "pending":
+            data["resume"] = url_for("batch_results", id=batch_id)
+        lines.append(data)
+    return Response(
+        "".join(json.dumps(data) + "\n" for data in lines),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.route("/api/batch", methods=["POST"])
+def batch():
+    """
+    Optimize a batch of portfolios, posted as JSON
+    {"portfolios": {id: {ticker: quantity}}, "engine": "qp", ...}. Prices are
+    fetched once for the union of the tickers.
+    """
+    body = request.get_json(force=True, silent=True) or {}
+    portfolios = body.get("portfolios")
+    options = {
+        key: body[key]
+        for key in ["engine", "cov", "population", "generations"]
+        if key in body
+    }
+    try:
+        validate_batch(portfolios, options)
+    except ValueError as error:
+        abort(400, description=str(error))
+    batch_id = submit_batch(conn, portfolios, options)
+    job_ids = batch_jobs(conn, batch_id)
+    return batch_response(batch_id, job_ids, {"batch_id": batch_id, "jobs": job_ids})
+
+
+@app.route("/api/batch/<string:id>")
+def batch_results(id):
+    """
+    Results of a batch so far (results already sent are repeated)
+    """
+    job_ids = batch_jobs(conn, id)
+    if job_ids is None:
+        abort(404)
+    return batch_response(id, job_ids)
 
-        kwargs["title"] = ""
-        # add data frame data to the Results page
-        kwargs["tables"] = [df.to_html(classes="data")]
-        kwargs["titles"] = df.columns.values
-        kwargs["row_data"] = list(df.values.tolist())
-        kwargs[
-            "text_selected"
-        ] = idx  # f'Index of currently selected solution is {idx} and this point is shown in the below graph with a blue circle'
 
-        return render_template("Results.html", **kwargs)
+@app.route("/metrics")
+def metrics():
+    """
+    Prometheus metrics: stage durations, queue depths and worker busy time
+    """
+    workers = Worker.all(connection=conn)
+    return Response(
+        render_metrics(conn, queues.values(), workers), mimetype="text/plain; version=0.0.4"
+    )
 
 
 @app.route("/About")
@@ -0,0 +1,109 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from rq import get_current_job
+
+from prices import fetch_histories
+from metrics import timer
+from panel import PricePanel, RollingStats
+from optimization import Optimize
+
+
+def select_points(df_res, X, points):
+    """
+    Weights of the chosen frontier points: a fraction of the way from the
+    minimum volatility (0) to the maximum return (1) solution, or
+    "max_sharpe"
+    """
+    order = np.argsort(df_res["EV"].to_numpy())
+    W = []
+    for point in points:
+        if point == "max_sharpe":
+            row = int(np.argmax(df_res["SR"].to_numpy()))
+        else:
+            row = order[int(round(point * (len(order) - 1)))]
+        w = np.clip(X[row], 0, None)
+        W.append(w / w.sum())
+    return np.array(W)
+
+
+def walk_forward(
+    prices,
+    window=252,
+    rebalance=21,
+    points=(0.0, 0.5, 1.0, "max_sharpe"),
+    engine="qp",
+    population=50,
+    generations=1000,
+):
+    """
+    Walk-forward backtest of frontier portfolios on a (dates x tickers)
+    close price frame. Every rebalance days the frontier is optimized on the
+    log returns of the last window days and the chosen points (see
+    select_points) are held until the next rebalance. The return statistics
+    are rolled forward with rank-1 updates and each optimization is
+    warm-started from the previous frontier.
+
+    Returns the equity curves (one column per point, starting at 1 on the
+    first rebalance) and the weights of each point at every rebalance date.
+    """
+    tickers = list(prices.columns)
+    P = prices.to_numpy(dtype=float)
+    R = np.log(P[1:] / P[:-1])  # R[i] is the return from day i to day i + 1
+    if len(R) <= window:
+        raise ValueError(f"Need more than {window + 1} prices for the backtest")
+    names = [p if isinstance(p, str) else f"{p:.0%}" for p in points]
+    rolling = RollingStats(R[:window])
+    equity = np.ones((len(P) - window, len(points)))
+    weights = []
+    X = None
+    # equal weights until a feasible frontier is found
+    W = np.full((len(points), len(tickers)), 1 / len(tickers))
+    for t in range(window, len(P) - 1, rebalance):
+        # slide the window up to the returns known at the close of day t
+        for day in range(t - rebalance if t > window else t, t):
+            rolling.roll(R[day], R[day - window])
+        stats = rolling.stats(n=window)
+        df_stat = pd.DataFrame({"ER": stats["ER"]}, index=tickers)
+        Cov = pd.DataFrame(stats["Cov"], index=tickers, columns=tickers)
+        df_res, X_new = Optimize(
+            tickers,
+            df_stat,
+            Cov,
+            population=population,
+            generations=generations,
+            engine=engine,
+            X0=X,
+        )
+        if X_new is not None:
+            X = X_new
+            W = select_points(df_res, X, points)
+        weights.append(W)
+        # buy and hold until the next rebalance
+        stop = min(t + rebalance, len(P) - 1)
+        growth = P[t + 1 : stop + 1] / P[t]
+        start = t - window
+        equity[start + 1 : stop - window + 1] = equity[start] * (growth @ W.T)
+    dates = prices.index[window::rebalance][: len(weights)]
+    df_equity = pd.DataFrame(equity, index=prices.index[window:], columns=names)
+    df_weights = {
+        name: pd.DataFrame(
+            np.array([W[i] for W in weights]), index=dates, columns=tickers
+        )
+        for i, name in enumerate(names)
+    }
+    return df_equity, df_weights
+
+
+def process_backtest(portfolio, years=5, window=252, rebalance=21, **kwargs):
+    """
+    Fetch years of history of the stocks of portfolio and run walk_forward
+    """
+    job = get_current_job()
+    start = (datetime.now() - timedelta(365 * years + window * 7 // 5)).date()
+    with timer("gethistory", job):
+        histories = fetch_histories(portfolio, start)
+    panel = PricePanel.from_frames([close for close, _ in histories])
+    with timer("backtest", job):
+        return walk_forward(panel.to_frame(), window, rebalance, **kwargs)
@@ -0,0 +1,205 @@
+"""
+Benchmarks of the optimization pipeline on synthetic price data (no network).
+
+    python benchmark.py                      # run and compare with the baseline
+    python benchmark.py --save-baseline      # run and store a new baseline
+    python benchmark.py --sizes 3 10 --years 1 --generations 50
+
+Each stage is timed (best of --repeat runs) and its peak traced memory is
+measured in a separate run. A stage regresses when its time or peak memory
+exceeds the baseline by more than --tolerance (relative).
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from optimization import getPercentChange, getStats, getMC, Optimize, Solutions
+from optimization import frontier_results, sample_weights
+from plotting import get_layout, plotPareto
+
+BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json"
+)
+
+# absolute slack added to the relative tolerance so that noise on very short
+# or very small stages is not reported as a regression
+SLACK = {"time": 0.005, "peak_mb": 0.1}
+
+
+def synthetic_prices(n_tickers, years, seed=0):
+    """
+    Daily OHLC histories of n_tickers correlated random-walk stocks over years
+    of business days. Returns the close price frame and the OHLC frames.
+    """
+    rng = np.random.default_rng(seed)
+    n_days = int(252 * years)
+    dates = pd.bdate_range(
+        end="2021-07-30", periods=n_days, tz="US/Eastern", name="Date"
+    )
+    # one market factor plus idiosyncratic noise
+    market = rng.normal(0.0003, 0.01, (n_days, 1))
+    beta = rng.uniform(0.5, 1.5, n_tickers)
+    log_ret = market * beta + rng.normal(0.0002, 0.015, (n_days, n_tickers))
+    close = 100 * np.exp(np.cumsum(log_ret, axis=0))
+    tickers = [f"T{i:03d}" for i in range(n_tickers)]
+    df = pd.DataFrame(close, index=dates, columns=tickers)
+    histories = {}
+    for i, ticker in enumerate(tickers):
+        open_ = close[:, i] * np.exp(rng.normal(0, 0.005, n_days))
+        spread = np.abs(rng.normal(0, 0.01, n_days))
+        histories[ticker] = pd.DataFrame(
+            {
+                "Open": open_,
+                "High": np.maximum(open_, close[:, i]) * (1 + spread),
+                "Low": np.minimum(open_, close[:, i]) * (1 - spread),
+                "Close": close[:, i],
+            },
+            index=dates,
+        )
+    return df, histories
+
+
+def measure(func, repeat):
+    """
+    Best wall time over repeat runs and peak traced memory (MB) of func()
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {"time": best, "peak_mb": peak / 2**20}
+
+
+def run_case(n_tickers, years, args):
+    """
+    Benchmark every pipeline stage for one portfolio size and history length
+    """
+    df, histories = synthetic_prices(n_tickers, years)
+    portfolio = {ticker: 10 for ticker in df.columns}
+    allocation = [value * df.iloc[-1][key] for key, value in portfolio.items()]
+    allocated_weights = np.array(allocation) / np.array(allocation).sum()
+    stats = {}
+
+    df_pct, stats["getPercentChange"] = measure(
+        lambda: getPercentChange(portfolio, df), args.repeat
+    )
+    (df_stat, Corr, Cov), stats["getStats"] = measure(
+        lambda: getStats(portfolio, df_pct), args.repeat
+    )
+    df_mc, stats["getMC"] = measure(
+        lambda: getMC(portfolio, df_pct, df_stat, Cov, n=args.mc, rng=0), args.repeat
+    )
+    X = None
+    for engine in args.engines:
+        if engine == "qp" and n_tickers > args.qp_max_tickers:
+            continue
+        (df_res, X), stats[f"Optimize[{engine}]"] = measure(
+            lambda: Optimize(
+                portfolio,
+                df_stat,
+                Cov,
+                population=args.population,
+                generations=args.generations,
+                engine=engine,
+            ),
+            1,
+        )
+    _, stats["get_layout"] = measure(lambda: get_layout(histories), args.repeat)
+    if X is None or len(X) == 0:
+        # no engine ran at this size, or NSGA2 found no feasible portfolio
+        # within the generation budget: the later stages are measured on
+        # random feasible portfolios instead
+        print(f"{n_tickers} tickers, {years} years: no Pareto solution")
+        X = sample_weights(n_tickers, args.population, rng=0)
+        df_res = frontier_results(X, df_stat["ER"], Cov)
+    _, stats["Solutions"] = measure(
+        lambda: Solutions(df_res, X, portfolio, allocation, allocated_weights, 0),
+        args.repeat,
+    )
+    _, stats["plotPareto"] = measure(
+        lambda: plotPareto(df_mc, df_res, 0.2, 0.1, 0), args.repeat
+    )
+    return stats
+
+
+def compare(results, baseline, tolerance):
+    """
+    List of regressions of results with respect to baseline
+    """
+    regressions = []
+    for case, stages in results.items():
+        for stage, stats in stages.items():
+            base = baseline.get(case, {}).get(stage)
+            if base is None:
+                continue
+            for metric in ["time", "peak_mb"]:
+                limit = base[metric] * (1 + tolerance) + SLACK[metric]
+                if stats[metric] > limit:
+                    regressions.append(
+                        f"{case} {stage} {metric}: "
+                        f"{stats[metric]:.4g} (baseline {base[metric]:.4g})"
+                    )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[3, 10, 50, 100, 500])
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--engines", nargs="+", default=["nsga2", "qp"])
+    # the SLSQP frontier sweep grows roughly cubically with the ticker count
+    parser.add_argument("--qp-max-tickers", type=int, default=100)
+    parser.add_argument("--population", type=int, default=100)
+    parser.add_argument("--generations", type=int, default=100)
+    parser.add_argument("--mc", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for n_tickers in args.sizes:
+        for years in args.years:
+            case = f"{n_tickers} tickers, {years} years"
+            results[case] = run_case(n_tickers, years, args)
+            for stage, stats in results[case].items():
+                print(
+                    f"{case:>24} {stage:>18} "
+                    f"{stats['time']:10.4f} s {stats['peak_mb']:10.1f} MB",
+                    flush=True,
+                )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline first")
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print("REGRESSION", regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
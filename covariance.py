@@ -0,0 +1,103 @@
+import numpy as np
+
+
+class FactorCovariance:
+    """
+    Covariance B F B^T + diag(d) of a k-factor model. Portfolio variances
+    cost O(nk) per portfolio instead of O(n^2) with the dense matrix.
+    """
+
+    def __init__(self, B, F, d):
+        self.B = np.asarray(B, dtype=float)  # (n, k) loadings
+        self.F = np.asarray(F, dtype=float)  # (k, k) factor covariance
+        self.d = np.asarray(d, dtype=float)  # (n,) specific variances
+
+    @property
+    def shape(self):
+        return (len(self.d), len(self.d))
+
+    def astype(self, dtype):
+        return FactorCovariance(
+            self.B.astype(dtype), self.F.astype(dtype), self.d.astype(dtype)
+        )
+
+    def scale(self, n):
+        return FactorCovariance(self.B, self.F * n, self.d * n)
+
+    def diag(self):
+        return np.einsum("ij,jk,ik->i", self.B, self.F, self.B) + self.d
+
+    def dot(self, w):
+        return self.B @ (self.F @ (self.B.T @ w)) + self.d * w
+
+    def quad(self, W):
+        """
+        Variances of the portfolios in the rows of W
+        """
+        WB = W @ self.B
+        return np.einsum("ij,ij->i", WB @ self.F, WB) + (W * W) @ self.d
+
+    def to_array(self):
+        return self.B @ self.F @ self.B.T + np.diag(self.d)
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.to_array()
+        return out if dtype is None else out.astype(dtype)
+
+
+def as_covariance(cov, dtype=float):
+    """
+    Keep a FactorCovariance structured, convert anything else to an ndarray
+    """
+    if isinstance(cov, FactorCovariance):
+        return cov.astype(dtype)
+    return np.asarray(cov, dtype=dtype)
+
+
+def covariance_diag(cov):
+    if isinstance(cov, FactorCovariance):
+        return cov.diag()
+    return np.diag(np.asarray(cov, dtype=float))
+
+
+def ledoit_wolf(R):
+    """
+    Ledoit-Wolf shrinkage of the sample covariance of the rows of R towards
+    a scaled identity (Ledoit and Wolf, 2004). Returns the covariance and
+    the shrinkage intensity.
+    """
+    T, n = R.shape
+    X = R - R.mean(axis=0)
+    S = X.T @ X / T
+    mu = np.trace(S) / n
+    S_norm2 = np.sum(S * S)
+    delta2 = (S_norm2 - 2 * mu * np.trace(S) + n * mu**2) / n
+    # sum over days of ||x_t x_t^T - S||_F^2 without forming the outer products
+    beta2 = (np.sum(np.sum(X * X, axis=1) ** 2) - T * S_norm2) / (T**2 * n)
+    shrinkage = 0.0 if delta2 == 0 else min(beta2, delta2) / delta2
+    cov = shrinkage * mu * np.eye(n) + (1 - shrinkage) * S
+    return cov, shrinkage
+
+
+def factor_model(R, k=None, factors=None):
+    """
+    k-factor covariance of the rows of R. Without factors the loadings are
+    the top k principal components; with factors (dates x k factor returns)
+    the loadings are the least-squares betas on those factors.
+    """
+    T, n = R.shape
+    X = R - R.mean(axis=0)
+    sample_var = np.sum(X * X, axis=0) / (T - 1)
+    if factors is None:
+        k = min(k or 5, n, T - 1)
+        # SVD of the (T x n) returns is cheaper than an n x n eigen-decomposition
+        _, s, Vt = np.linalg.svd(X, full_matrices=False)
+        B = Vt[:k].T * (s[:k] / np.sqrt(T - 1))
+        F = np.eye(k)
+    else:
+        Z = np.asarray(factors, dtype=float)
+        Z = Z - Z.mean(axis=0)
+        B = np.linalg.lstsq(Z, X, rcond=None)[0].T
+        F = Z.T @ Z / (T - 1)
+    d = np.maximum(sample_var - np.einsum("ij,jk,ik->i", B, F, B), 1e-12)
+    return FactorCovariance(B, F, d)
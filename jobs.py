@@ -0,0 +1,280 @@
+import hashlib
+import json
+import math
+import os
+import pickle
+import uuid
+from datetime import datetime
+
+import numpy as np
+import pytz
+from rq import Queue
+from rq.job import Job
+from redis.exceptions import WatchError
+from rq.exceptions import NoSuchJobError
+
+# seconds a finished optimization stays reusable for an identical portfolio
+CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 6 * 60 * 60))
+# seconds a Pareto set is kept to warm-start later runs on the same tickers
+FRONT_TTL = int(os.getenv("FRONT_TTL", 7 * 24 * 60 * 60))
+# job statuses that must not be reused
+FAILED_STATUSES = ["failed", "stopped", "canceled"]
+# highest estimated cost (see job_cost) of a job sent to the "high" and
+# "default" queues, costlier jobs go to "low"
+QUEUE_COSTS = [
+    ("high", float(os.getenv("HIGH_QUEUE_MAX_COST", 10))),
+    ("default", float(os.getenv("DEFAULT_QUEUE_MAX_COST", 50))),
+]
+
+# options a batch may set, and the largest population and generation count
+BATCH_ENGINES = ["nsga2", "qp", "islands"]
+BATCH_COVS = ["sample", "ledoit_wolf", "factor"]
+MAX_POPULATION = int(os.getenv("BATCH_MAX_POPULATION", 1000))
+MAX_GENERATIONS = int(os.getenv("BATCH_MAX_GENERATIONS", 5000))
+# seconds a batch job may run before rq stops it
+BATCH_JOB_TIMEOUT = int(os.getenv("BATCH_JOB_TIMEOUT", 3600))
+
+
+def portfolio_key(portfolio, as_of=None, options=None):
+    """
+    Canonical cache key of a portfolio (ticker -> quantity), data as-of date
+    and optimization options
+    """
+    if as_of is None:
+        as_of = datetime.now(pytz.timezone("US/Eastern")).date()
+    data = {"portfolio": sorted(portfolio.items()), "as_of": str(as_of)}
+    if options:
+        data["options"] = sorted(options.items())
+    canonical = json.dumps(data, separators=(",", ":"))
+    return "portfolio:" + hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def job_cost(n_tickers, engine="nsga2"):
+    """
+    Rough cost of an optimization in tickers: NSGA2 grows about linearly
+    with the ticker count, the SLSQP frontier sweep about cubically
+    """
+    if engine == "qp":
+        return n_tickers * max(1.0, n_tickers / 25) ** 2
+    return float(n_tickers)
+
+
+def job_queue(n_tickers, engine="nsga2"):
+    """
+    Name of the queue of an optimization of n_tickers stocks with engine
+    """
+    cost = job_cost(n_tickers, engine)
+    for name, max_cost in QUEUE_COSTS:
+        if cost <= max_cost:
+            return name
+    return "low"
+
+
+def submit_portfolio(q, func, portfolio, ttl=CACHE_TTL, **options):
+    """
+    Enqueue func(portfolio, **options) unless an identical portfolio with the
+    same options is already queued, running or finished within ttl; in that
+    case return the existing job
+    """
+    key = portfolio_key(portfolio, options=options)
+    conn = q.connection
+    # the job is saved before its id is published under the key, so a
+    # request that reads the key can always fetch the job
+    job = q.create_job(func, args=(portfolio,), kwargs=options, result_ttl=ttl)
+    job.save()
+    for _ in range(2):
+        # only one request can claim the key, the others attach to its job
+        if conn.set(key, job.id, ex=ttl, nx=True):
+            return q.enqueue_job(job)
+        existing = conn.get(key)
+        if existing is None:
+            continue
+        try:
+            other = Job.fetch(existing.decode(), connection=conn)
+        except NoSuchJobError:
+            other = None
+        if other is not None and other.get_status() not in FAILED_STATUSES:
+            job.delete()
+            return other
+        # stale entry (failed or expired job), release it unless another
+        # request replaced it in the meantime
+        release_key(conn, key, existing)
+    return q.enqueue_job(job)
+
+
+def release_key(conn, key, value):
+    """
+    Delete key if it still holds value
+    """
+    with conn.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            if pipe.get(key) == value:
+                pipe.multi()
+                pipe.delete(key)
+                pipe.execute()
+        except WatchError:
+            pass
+
+
+def front_key(tickers):
+    """
+    Key of the stored Pareto set of a set of tickers
+    """
+    canonical = json.dumps(sorted(tickers), separators=(",", ":"))
+    return "front:" + hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def save_front(conn, portfolio, X, ttl=FRONT_TTL):
+    """
+    Store the Pareto set X (one column per stock of portfolio). Nothing is
+    stored when the optimization found no feasible solution (X is None).
+    """
+    if X is None or len(X) == 0:
+        return
+    front = {"tickers": list(portfolio), "X": np.asarray(X)}
+    conn.set(front_key(portfolio), pickle.dumps(front), ex=ttl)
+
+
+def load_front(conn, portfolio):
+    """
+    Stored Pareto set for the tickers of portfolio with its columns in the
+    order of portfolio, or None. Sets that do not match the tickers of
+    portfolio (e.g. stored by an older version) are ignored.
+    """
+    blob = conn.get(front_key(portfolio))
+    if blob is None:
+        return None
+    front = pickle.loads(blob)
+    X = front["X"]
+    if X.ndim != 2 or len(X) == 0 or X.shape[1] != len(front["tickers"]):
+        return None
+    if sorted(front["tickers"]) != sorted(portfolio):
+        return None
+    order = [front["tickers"].index(ticker) for ticker in portfolio]
+    return X[:, order]
+
+
+def validate_batch(portfolios, options):
+    """
+    Check the portfolios (id -> {ticker: quantity}) and options of a batch,
+    raising ValueError with the first problem found
+    """
+    if not isinstance(portfolios, dict) or not portfolios:
+        raise ValueError("portfolios must be a non-empty object")
+    for portfolio_id, portfolio in portfolios.items():
+        if not isinstance(portfolio, dict) or not portfolio:
+            raise ValueError(f"portfolio {portfolio_id} must be a non-empty object")
+        for ticker, quantity in portfolio.items():
+            if not ticker.strip():
+                raise ValueError(f"portfolio {portfolio_id} has an empty ticker")
+            if (
+                isinstance(quantity, bool)
+                or not isinstance(quantity, (int, float))
+                or not math.isfinite(quantity)
+                or quantity <= 0
+            ):
+                raise ValueError(
+                    f"portfolio {portfolio_id}: quantity of {ticker} must be a "
+                    f"positive number, got {quantity!r}"
+                )
+    if options.get("engine", "qp") not in BATCH_ENGINES:
+        raise ValueError(f"engine must be one of {', '.join(BATCH_ENGINES)}")
+    if options.get("cov", "sample") not in BATCH_COVS:
+        raise ValueError(f"cov must be one of {', '.join(BATCH_COVS)}")
+    for key, low, high in [
+        ("population", 2, MAX_POPULATION),
+        ("generations", 1, MAX_GENERATIONS),
+    ]:
+        value = options.get(key, low)
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError(f"{key} must be an integer")
+        if not low <= value <= high:
+            raise ValueError(f"{key} must be between {low} and {high}")
+
+
+def submit_batch(conn, portfolios, options=None, queue="low", ttl=CACHE_TTL):
+    """
+    Enqueue a batch of portfolios (id -> {ticker: quantity}). One
+    prepare_universe job fetches the prices of the union of their tickers,
+    and one optimize_batch_portfolio job per portfolio depends on it and
+    computes the statistics of its own tickers. Every job may run for
+    options["timeout"] seconds. Returns the batch id.
+    """
+    options = options or {}
+    timeout = options.get("timeout", BATCH_JOB_TIMEOUT)
+    q = Queue(queue, connection=conn)
+    tickers = sorted(
+        {ticker for portfolio in portfolios.values() for ticker in portfolio}
+    )
+    universe = q.enqueue(
+        "optimization.prepare_universe",
+        tickers,
+        result_ttl=ttl,
+        job_timeout=timeout,
+    )
+    batch_id = str(uuid.uuid4())
+    job_ids = {}
+    for portfolio_id, portfolio in portfolios.items():
+        job = q.enqueue(
+            "optimization.optimize_batch_portfolio",
+            universe.id,
+            str(portfolio_id),
+            portfolio,
+            engine=options.get("engine", "qp"),
+            population=options.get("population", 100),
+            generations=options.get("generations", 1000),
+            cov=options.get("cov", "sample"),
+            depends_on=universe,
+            result_ttl=ttl,
+            job_timeout=timeout,
+        )
+        job_ids[str(portfolio_id)] = job.id
+    conn.hset(f"batch:{batch_id}", mapping=job_ids)
+    conn.expire(f"batch:{batch_id}", ttl)
+    return batch_id
+
+
+def batch_jobs(conn, batch_id):
+    """
+    Portfolio id -> job id of a batch, or None if the batch is unknown
+    """
+    job_ids = conn.hgetall(f"batch:{batch_id}")
+    if not job_ids:
+        return None
+    return {k.decode(): v.decode() for k, v in job_ids.items()}
+
+
+def last_error(job):
+    lines = (job.exc_info or "").strip().splitlines()
+    return lines[-1] if lines else None
+
+
+def batch_status(conn, job_ids):
+    """
+    Yield the result (or failure) of each portfolio of a batch whose job has
+    ended, then the number of pending jobs if some are still running. It
+    does not wait, clients poll again for the pending ones.
+    """
+    pending = 0
+    jobs = Job.fetch_many(list(job_ids.values()), connection=conn)
+    for portfolio_id, job in zip(job_ids, jobs):
+        status = job.get_status() if job is not None else None
+        # a failed prepare_universe job leaves its dependents deferred
+        dependency = job.dependency if status == "deferred" else None
+        if job is None:
+            yield {"id": portfolio_id, "status": "expired"}
+        elif status == "finished":
+            yield dict(job.result, status="finished")
+        elif status in FAILED_STATUSES:
+            yield {"id": portfolio_id, "status": "failed", "error": last_error(job)}
+        elif dependency is not None and dependency.get_status() in FAILED_STATUSES:
+            yield {
+                "id": portfolio_id,
+                "status": "failed",
+                "error": last_error(dependency),
+            }
+        else:
+            pending += 1
+    if pending:
+        yield {"status": "pending", "pending": pending}
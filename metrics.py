@@ -0,0 +1,91 @@
+import time
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the stage duration histogram buckets
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+PREFIX = "metrics:stage"
+
+
+def observe(conn, stage, seconds):
+    """
+    Add one duration of stage to the histogram aggregated in Redis
+    """
+    key = f"{PREFIX}:{stage}"
+    pipe = conn.pipeline()
+    for le in BUCKETS:
+        if seconds <= le:
+            pipe.hincrby(key, str(le), 1)
+    pipe.hincrby(key, "+Inf", 1)
+    pipe.hincrbyfloat(key, "sum", seconds)
+    pipe.sadd(PREFIX + "s", stage)
+    pipe.execute()
+
+
+@contextmanager
+def timer(stage, job=None, conn=None):
+    """
+    Time the enclosed block, record it in job.meta["timings"] and add it to
+    the histogram of stage (conn defaults to the connection of job)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if job is not None:
+            job.meta.setdefault("timings", {})[stage] = seconds
+            job.save_meta()
+            conn = conn or job.connection
+        if conn is not None:
+            observe(conn, stage, seconds)
+
+
+def render_metrics(conn, queues, workers):
+    """
+    Stage duration histograms, queue depths and worker busy time in the
+    Prometheus text exposition format
+    """
+    lines = [
+        "# HELP portfolio_stage_duration_seconds Duration of each pipeline stage.",
+        "# TYPE portfolio_stage_duration_seconds histogram",
+    ]
+    for stage in sorted(s.decode() for s in conn.smembers(PREFIX + "s")):
+        counts = {
+            k.decode(): v.decode() for k, v in conn.hgetall(f"{PREFIX}:{stage}").items()
+        }
+        for le in [str(le) for le in BUCKETS] + ["+Inf"]:
+            lines.append(
+                f'portfolio_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} '
+                f"{int(counts.get(le, 0))}"
+            )
+        lines.append(
+            f'portfolio_stage_duration_seconds_sum{{stage="{stage}"}} '
+            f"{float(counts.get('sum', 0))}"
+        )
+        lines.append(
+            f'portfolio_stage_duration_seconds_count{{stage="{stage}"}} '
+            f"{int(counts.get('+Inf', 0))}"
+        )
+    lines += [
+        "# HELP rq_queue_jobs Number of jobs waiting in each queue.",
+        "# TYPE rq_queue_jobs gauge",
+    ]
+    for queue in queues:
+        lines.append(f'rq_queue_jobs{{queue="{queue.name}"}} {queue.count}')
+    lines += [
+        "# HELP rq_worker_busy_seconds_total Time each worker spent running jobs.",
+        "# TYPE rq_worker_busy_seconds_total counter",
+    ]
+    for worker in workers:
+        lines.append(
+            f'rq_worker_busy_seconds_total{{worker="{worker.name}"}} '
+            f"{worker.total_working_time}"
+        )
+    lines += [
+        "# HELP rq_worker_busy Whether each worker is currently running a job.",
+        "# TYPE rq_worker_busy gauge",
+    ]
+    for worker in workers:
+        busy = int(worker.get_state() == "busy")
+        lines.append(f'rq_worker_busy{{worker="{worker.name}"}} {busy}')
+    return "\n".join(lines) + "\n"
@@ -1,25 +1,68 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-import yfinance as yf
 import numpy as np
 import pandas as pd
-from pymoo.model.problem import FunctionalProblem
+from pymoo.model.problem import Problem
+from pymoo.model.termination import Termination
+from pymoo.model.callback import Callback
 from pymoo.algorithms.nsga2 import NSGA2
 from pymoo.factory import get_sampling, get_crossover, get_mutation
-from pymoo.factory import get_termination
+from pymoo.factory import get_termination, get_performance_indicator
 from pymoo.optimize import minimize
+from pymoo.util.nds.non_dominated_sorting import NonDominatedSorting
 from pymoo.model.problem import ConstraintsAsPenaltyProblem
-from functools import reduce
+from scipy.optimize import minimize as sp_minimize
+from rq import get_current_job
+from rq.job import Job
+from prices import fetch_history, fetch_histories, get_store, to_records
+from jobs import load_front, save_front
+from results import pack_result
+from metrics import timer
+from panel import PricePanel, log_returns, return_stats
+from covariance import FactorCovariance, as_covariance, covariance_diag
+from covariance import ledoit_wolf, factor_model
+from solutions import Solutions, select_solution
 
+# percent complete of a process_portfolio job when each stage starts
+STAGES = {"fetching": 0, "statistics": 20, "monte_carlo": 25, "optimizing": 30}
 
-def gethistory(stock):
+
+def report_stage(job, stage):
+    """
+    Record the current stage of a job and its percent complete in job.meta
+    """
+    if job is None:
+        return
+    job.meta["stage"] = stage
+    job.meta["percent"] = STAGES[stage]
+    job.save_meta()
+
+
+def gethistory(stock, provider=None):
     """
     Get stock histories for the last 365 days (day close prices)
     """
-    ticker = yf.Ticker(stock)
-    tmp = ticker.history(start=(datetime.now() - timedelta(365)).date(), interval="1d")
-    tmp.index = pd.to_datetime(tmp.index, utc=True)
-    tmp.index = tmp.index.tz_convert("US/Eastern")
-    return tmp[["Close"]].rename(columns={"Close": stock}), tmp
+    return fetch_history(stock, (datetime.now() - timedelta(365)).date(), provider)
+
+
+def gethistories(
+    stocks, provider=None, max_workers=8, timeout=30, retries=2, return_exceptions=False
+):
+    """
+    Get stock histories for the last 365 days for several stocks concurrently
+    """
+    return fetch_histories(
+        stocks,
+        (datetime.now() - timedelta(365)).date(),
+        provider,
+        max_workers=max_workers,
+        timeout=timeout,
+        retries=retries,
+        return_exceptions=return_exceptions,
+    )
 
 
 def getPercentChange(portfolio, df):
@@ -27,24 +70,36 @@ def getPercentChange(portfolio, df):
     Calculate log of daily percentage change
     """
     tmp = df.copy()
-    for item in portfolio:
-        # Log of percentage change
-        tmp[item] = tmp[item].pct_change().apply(lambda x: np.log(1 + x))
+    items = list(portfolio)
+    tmp[items] = log_returns(tmp[items].to_numpy(dtype=float))
     return tmp
 
 
-def getStats(portfolio, df_pct):
+def getStats(portfolio, df_pct, cov="sample", k=None, factors=None):
     """
-    Get statistics, correlation and covariance matrices. Variabnce of log of percentage change
+    Get statistics, correlation and covariance matrices. Variabnce of log of percentage change.
+    cov selects the covariance estimator: "sample", "ledoit_wolf" (shrinkage)
+    or "factor" (k principal components, or the given factor returns), which
+    is returned as a FactorCovariance instead of a DataFrame.
     """
-    tmp = pd.DataFrame()
-    tmp["Mean"] = df_pct.mean()
-    tmp["Var"] = df_pct.var()
-    tmp["Std"] = df_pct.std()
-    tmp["Volitility"] = tmp["Std"].apply(lambda x: x * np.sqrt(df_pct.shape[0]))
-    tmp["ER"] = tmp["Mean"].apply(lambda x: x * df_pct.shape[0])
-    Corr = df_pct.corr()
-    Cov = df_pct.cov() * df_pct.shape[0]
+    values = df_pct.to_numpy(dtype=float)
+    R = values[~np.isnan(values).any(axis=1)]
+    n = df_pct.shape[0]
+    stats = return_stats(R, n=n)
+    tmp = pd.DataFrame(
+        {name: stats[name] for name in ["Mean", "Var", "Std", "Volitility", "ER"]},
+        index=df_pct.columns,
+    )
+    Corr = pd.DataFrame(stats["Corr"], index=df_pct.columns, columns=df_pct.columns)
+    if cov == "sample":
+        Cov = pd.DataFrame(stats["Cov"], index=df_pct.columns, columns=df_pct.columns)
+    elif cov == "ledoit_wolf":
+        shrunk, _ = ledoit_wolf(R)
+        Cov = pd.DataFrame(shrunk * n, index=df_pct.columns, columns=df_pct.columns)
+    elif cov == "factor":
+        Cov = factor_model(R, k=k, factors=factors).scale(n)
+    else:
+        raise ValueError(f"Unknown covariance estimator: {cov}")
     return tmp, Corr, Cov
 
 
@@ -59,100 +114,604 @@ def expected_vol(weights, Cov):
     """
     Calculate expected portfolio volitility
     """
+    if isinstance(Cov, FactorCovariance):
+        return np.sqrt(Cov.quad(np.asarray(weights)[None])[0])
     return np.sqrt(np.dot(weights.T, np.dot(Cov, weights)))
 
 
-def getMC(portfolio, df_pct, df_stat, Cov, n=5000):
+def expected_return_batch(W, er):
+    """
+    Calculate expected returns for a matrix of weights (one portfolio per row)
+    """
+    return W @ er
+
+
+def expected_vol_batch(W, cov):
+    """
+    Calculate expected volitilities for a matrix of weights (one portfolio per row)
+    """
+    if isinstance(cov, FactorCovariance):
+        return np.sqrt(np.maximum(cov.quad(W), 0))
+    return np.sqrt(np.maximum(np.einsum("ij,ij->i", W @ cov, W), 0))
+
+
+def scenario_matrix(df_pct, method="historical", n=None, rng=None):
+    """
+    (scenarios x stocks) matrix of daily simple returns used for CVaR:
+    the observed days of df_pct (method="historical") or n days drawn from
+    them with replacement (method="bootstrap")
+    """
+    values = df_pct.to_numpy(dtype=float)
+    R = np.expm1(values[~np.isnan(values).any(axis=1)])
+    if method == "historical":
+        return R
+    if method == "bootstrap":
+        rng = np.random.default_rng(rng)
+        return R[rng.integers(0, len(R), n or 10 * len(R))]
+    raise ValueError(f"Unknown scenario method: {method}")
+
+
+def cvar_batch(W, scenarios, level=0.95):
+    """
+    Conditional value at risk (mean loss of the worst 1 - level fraction of
+    scenarios) of the portfolios in the rows of W
+    """
+    losses = -(scenarios @ W.T)  # (scenarios x portfolios)
+    k = max(1, int(np.ceil((1 - level) * len(scenarios))))
+    worst = np.partition(losses, len(losses) - k, axis=0)[-k:]
+    return worst.mean(axis=0)
+
+
+def sample_weights(
+    n_assets, size, method="uniform", alpha=1.0, rng=None, dtype=np.float64
+):
+    """
+    Draw a (size, n_assets) matrix of long-only weights that sum to one.
+    method="uniform" normalizes uniform draws (the original getMC scheme),
+    method="simplex" samples uniformly on the simplex and method="dirichlet"
+    samples a Dirichlet distribution with concentration alpha.
     """
-    MonteCarlo simulation
+    rng = np.random.default_rng(rng)
+    if method == "uniform":
+        W = rng.random((size, n_assets), dtype=dtype)
+    elif method == "simplex":
+        W = rng.standard_exponential((size, n_assets), dtype=dtype)
+    elif method == "dirichlet":
+        W = rng.gamma(alpha, size=(size, n_assets)).astype(dtype, copy=False)
+    else:
+        raise ValueError(f"Unknown sampling method: {method}")
+    W /= W.sum(axis=1, keepdims=True)
+    return W
+
+
+def getMC(
+    portfolio,
+    df_pct,
+    df_stat,
+    Cov,
+    n=5000,
+    chunk_size=50000,
+    method="uniform",
+    alpha=1.0,
+    dtype=np.float64,
+    rng=None,
+):
     """
-    W = []  # weights
-    ER = []  # expected return
-    EV = []  # expected volitility
-    SR = []  # sharpe
-    for i in range(n):
+    MonteCarlo simulation. Weights are drawn and evaluated in chunks of
+    chunk_size rows so memory stays bounded for large n.
+    """
+    rng = np.random.default_rng(rng)
+    er = df_stat["ER"].to_numpy(dtype=dtype)
+    cov = as_covariance(Cov, dtype=dtype)
+    EV = np.empty(n, dtype=dtype)  # expected volitility
+    ER = np.empty(n, dtype=dtype)  # expected return
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
         # generate weights
-        weights = np.array(np.random.random(len(portfolio)))
-        weights = weights / np.sum(weights)
-        W.append(weights)
-        # ER
-        er = expected_return(weights, df_stat)
-        ER.append(er)
-        # EV
-        ev = expected_vol(weights, Cov)
-        EV.append(ev)
-        SR.append(er / ev)
-
-    df_mc = pd.DataFrame({"EV": EV, "ER": ER, "SR": SR})
+        W = sample_weights(len(portfolio), stop - start, method, alpha, rng, dtype)
+        ER[start:stop] = expected_return_batch(W, er)
+        EV[start:stop] = expected_vol_batch(W, cov)
+    df_mc = pd.DataFrame({"EV": EV, "ER": ER, "SR": ER / EV})
     return df_mc
 
 
-def Optimize(portfolio, df_stat, Cov, population=100, generations=1000, verbose=False):
+class PortfolioProblem(Problem):
+    """
+    Mean-variance portfolio problem evaluated for the whole population at once.
+    Objectives are -ER and EV, with |1 - sum(x)| <= constr_eq_eps as constraint.
+    Given a scenario matrix, the CVaR at cvar_level is a third objective.
+    """
+
+    def __init__(self, er, cov, constr_eq_eps=2e-02, scenarios=None, cvar_level=0.95):
+        self.er = np.asarray(er, dtype=float)
+        self.cov = as_covariance(cov)
+        self.constr_eq_eps = constr_eq_eps
+        self.scenarios = scenarios
+        self.cvar_level = cvar_level
+        n_var = len(self.er)
+        super().__init__(
+            n_var=n_var,
+            n_obj=2 if scenarios is None else 3,
+            n_constr=1,
+            xl=np.zeros(n_var),
+            xu=np.ones(n_var),
+            elementwise_evaluation=False,
+        )
+
+    def _evaluate(self, X, out, *args, **kwargs):
+        F = [-expected_return_batch(X, self.er), expected_vol_batch(X, self.cov)]
+        if self.scenarios is not None:
+            F.append(cvar_batch(X, self.scenarios, self.cvar_level))
+        out["F"] = np.column_stack(F)
+        out["G"] = (np.abs(1 - X.sum(axis=1)) - self.constr_eq_eps)[:, None]
+
+    def reference_point(self):
+        """
+        Point dominated by every feasible solution, used for the hypervolume
+        """
+        vol_max = np.sqrt(covariance_diag(self.cov)).max() * (1 + self.constr_eq_eps)
+        worst_return = -self.er.min() + self.constr_eq_eps * abs(self.er).max()
+        margin = 0.1 * np.array([np.ptp(self.er), vol_max])
+        ref_point = np.array([worst_return, vol_max]) + margin
+        if self.scenarios is not None:
+            # CVaR is convex, a portfolio is no worse than its worst stock
+            cvar_max = cvar_batch(np.eye(self.n_var), self.scenarios, self.cvar_level)
+            cvar_max = np.abs(cvar_max).max() * (1 + self.constr_eq_eps)
+            ref_point = np.append(ref_point, 1.1 * cvar_max)
+        return ref_point
+
+
+def hypervolume_2d(F, ref_point):
+    """
+    Hypervolume dominated by a set of 2-objective (minimized) points
+    """
+    F = F[(F < ref_point).all(axis=1)]
+    if len(F) == 0:
+        return 0.0
+    F = F[np.argsort(F[:, 0])]
+    # best second objective reached up to each point of the sorted front
+    f2 = np.minimum.accumulate(F[:, 1])
+    widths = np.diff(np.append(F[:, 0], ref_point[0]))
+    return float(np.sum(widths * (ref_point[1] - f2)))
+
+
+def hypervolume(F, ref_point):
+    """
+    Hypervolume dominated by a set of minimized points (2 or more objectives)
+    """
+    if F.shape[1] == 2:
+        return hypervolume_2d(F, ref_point)
+    F = F[(F < ref_point).all(axis=1)]
+    if len(F) == 0:
+        return 0.0
+    return float(get_performance_indicator("hv", ref_point=ref_point).calc(F))
+
+
+class FrontStagnationTermination(Termination):
+    """
+    Stop when the hypervolume of the feasible front improved by less than tol
+    (relative) over the last window generations, after n_max_gen generations
+    or after max_time seconds. n_gen and reason report why it stopped.
+    """
+
+    def __init__(self, ref_point, n_max_gen=1000, max_time=None, window=50, tol=1e-4):
+        super().__init__()
+        self.ref_point = ref_point
+        self.n_max_gen = n_max_gen
+        self.max_time = max_time
+        self.tol = tol
+        self.hv = deque(maxlen=window + 1)
+        self.start = None
+        self.n_gen = 0
+        self.reason = None
+
+    def _do_continue(self, algorithm, **kwargs):
+        if self.start is None:
+            self.start = time.time()
+        self.n_gen = algorithm.n_gen
+        if self.n_gen >= self.n_max_gen:
+            self.reason = "n_max_gen"
+            return False
+        if self.max_time is not None and time.time() - self.start >= self.max_time:
+            self.reason = "max_time"
+            return False
+        opt = algorithm.opt
+        if opt is None:
+            return True
+        F = opt.get("F")[opt.get("feasible")[:, 0]]
+        self.hv.append(hypervolume(F, self.ref_point))
+        if len(self.hv) == self.hv.maxlen and self.hv[-1] > 0:
+            if (self.hv[-1] - self.hv[0]) / self.hv[-1] < self.tol:
+                self.reason = "stagnation"
+                return False
+        return True
+
+
+def efficient_frontier(er, cov, n_points=100, X0=None):
+    """
+    Trace the long-only mean-variance frontier with a sweep of quadratic
+    programs (SLSQP), from the minimum variance portfolio to the maximum
+    return one. Each solve is warm-started from the previous target, the
+    first one from the least volatile row of X0 if given (e.g. the frontier
+    of a previous rebalance). Targets SLSQP does not converge on are
+    dropped, so the frontier may have fewer than n_points points.
+    """
+    er = np.asarray(er, dtype=float)
+    cov = np.asarray(cov, dtype=float)
+    n = len(er)
+    bounds = [(0, 1)] * n
+    budget = {"type": "eq", "fun": lambda w: w.sum() - 1, "jac": lambda w: np.ones(n)}
+    options = {"ftol": 1e-12, "maxiter": 500}
+
+    def variance(w):
+        return w @ cov @ w
+
+    def variance_jac(w):
+        return 2 * cov @ w
+
+    def solve(w0, constraints):
+        """
+        Weights of a solved QP, or None if SLSQP did not converge
+        """
+        sol = sp_minimize(
+            variance,
+            w0,
+            jac=variance_jac,
+            bounds=bounds,
+            constraints=constraints,
+            method="SLSQP",
+            options=options,
+        )
+        if not sol.success:
+            return None
+        w = np.clip(sol.x, 0, None)
+        return w / w.sum()
+
+    # minimum variance portfolio, from the least volatile row of X0 if given
+    if X0 is None:
+        w0 = np.full(n, 1 / n)
+    else:
+        X0 = np.asarray(X0, dtype=float)
+        w0 = X0[np.argmin(expected_vol_batch(X0, cov))]
+    w = solve(w0, [budget])
+    if w is None:
+        raise ValueError("Minimum variance portfolio did not converge")
+    # maximum return portfolio is fully invested in the best stock
+    w_max = np.zeros(n)
+    w_max[np.argmax(er)] = 1
+    W = [w]
+    for target in np.linspace(er @ w, er.max(), n_points)[1:-1]:
+        target_return = {
+            "type": "eq",
+            "fun": lambda w, t=target: er @ w - t,
+            "jac": lambda w: er,
+        }
+        # targets that do not converge are left out of the frontier, the
+        # next one starts from the last converged portfolio
+        solved = solve(w, [budget, target_return])
+        if solved is not None:
+            w = solved
+            W.append(w)
+    if n_points > 1:
+        W.append(w_max)
+    return np.array(W)
+
+
+class ProgressCallback(Callback):
+    """
+    Stream compact per-generation progress (generation, best Sharpe ratio and
+    front size) into job.meta every nth_gen generations. With n_snapshots > 0
+    the last n_snapshots feasible fronts are kept in a ring buffer.
+    """
+
+    def __init__(self, job=None, n_max_gen=None, nth_gen=10, n_snapshots=0):
+        super().__init__()
+        self.job = job
+        self.n_max_gen = n_max_gen
+        self.nth_gen = nth_gen
+        self.snapshots = deque(maxlen=n_snapshots) if n_snapshots > 0 else None
+        self.progress = {}
+
+    def notify(self, algorithm, **kwargs):
+        opt = algorithm.opt
+        F = opt.get("F")[opt.get("feasible")[:, 0]]
+        self.progress = {
+            "n_gen": algorithm.n_gen,
+            "n_max_gen": self.n_max_gen,
+            "best_sr": float(np.max(-F[:, 0] / F[:, 1])) if len(F) else None,
+            "front_size": len(F),
+        }
+        if self.snapshots is not None:
+            self.snapshots.append((algorithm.n_gen, F.copy()))
+        if self.job is not None and algorithm.n_gen % self.nth_gen == 0:
+            self.job.meta["progress"] = self.progress
+            if self.n_max_gen:
+                # optimization covers the last part of a process_portfolio job
+                start, stop = STAGES["optimizing"], 100
+                fraction = min(algorithm.n_gen / self.n_max_gen, 1)
+                self.job.meta["percent"] = int(start + (stop - start) * fraction)
+            self.job.save_meta()
+
+
+def Optimize(
+    portfolio,
+    df_stat,
+    Cov,
+    population=100,
+    generations=1000,
+    verbose=False,
+    engine="nsga2",
+    X0=None,
+    termination=None,
+    max_time=None,
+    job=None,
+    n_snapshots=0,
+    n_islands=4,
+    migration_interval=None,
+    scenarios=None,
+    cvar_level=0.95,
+):
     """
-    Multiobjective optimization
+    Multiobjective optimization. engine="nsga2" runs the genetic algorithm,
+    engine="qp" traces the exact frontier with population points.
+    X0 (e.g. a previous Pareto set) warm-starts NSGA2 or the QP sweep.
+    termination="n_gen" runs all generations, termination="adaptive" stops
+    once the front stagnates or after max_time seconds (default when
+    warm-started). df_res.attrs holds the generations used and the reason.
+    Progress is streamed into job.meta when an rq job is given, and the last
+    n_snapshots fronts are returned in df_res.attrs["snapshots"] if requested.
+    engine="islands" runs n_islands NSGA2 islands in parallel processes (see
+    island_model) and returns the non-dominated merge of their fronts.
+    With a scenario matrix (see scenario_matrix) the CVaR at cvar_level is a
+    third NSGA2 objective and a "CVaR" column of df_res; the qp engine only
+    reports it.
     """
+    er = df_stat["ER"].to_numpy()
+    if engine == "qp":
+        X = efficient_frontier(er, Cov, n_points=population, X0=X0)
+        df_res = frontier_results(X, er, Cov, scenarios, cvar_level)
+        df_res.attrs.update(n_gen=0, termination="exact")
+        return df_res, X
+    if engine == "islands":
+        X = island_model(
+            er,
+            Cov,
+            population=population,
+            generations=generations,
+            n_islands=n_islands,
+            migration_interval=migration_interval,
+            scenarios=scenarios,
+            cvar_level=cvar_level,
+        )
+        df_res = frontier_results(X, er, Cov, scenarios, cvar_level)
+        df_res.attrs.update(n_gen=generations, termination="n_max_gen")
+        return df_res, X
+    if engine != "nsga2":
+        raise ValueError(f"Unknown optimization engine: {engine}")
     # Define the problem
-    def expected_return(x):
-        return -np.sum(df_stat["ER"] * x)
-
-    def expected_vol(x):
-        return np.sqrt(np.dot(x.T, np.dot(Cov, x)))
-
-    objs = [expected_return, expected_vol]
-
-    constr_eq = [lambda x: 1 - x.sum()]
-    problem = FunctionalProblem(
-        len(portfolio),
-        objs,
-        constr_eq=constr_eq,
-        constr_eq_eps=2e-02,
-        xl=np.zeros(len(portfolio)),
-        xu=np.ones(len(portfolio)),
+    problem = PortfolioProblem(
+        er, Cov, constr_eq_eps=2e-02, scenarios=scenarios, cvar_level=cvar_level
     )
     # Define algorithm
-    algorithm = NSGA2(
-        pop_size=population,
-        n_offsprings=30,
-        sampling=get_sampling("real_random"),
-        crossover=get_crossover("real_sbx", prob=0.9, eta=15),
-        mutation=get_mutation("real_pm", eta=20),
-        eliminate_duplicates=True,
-    )
+    algorithm = nsga2_algorithm(population, len(portfolio), X0)
     # Termination criterion
-    termination = get_termination("n_gen", generations)
+    if termination is None:
+        termination = "n_gen" if X0 is None else "adaptive"
+    if termination == "n_gen":
+        criterion = get_termination("n_gen", generations)
+    elif termination == "adaptive":
+        criterion = FrontStagnationTermination(
+            problem.reference_point(), n_max_gen=generations, max_time=max_time
+        )
+    else:
+        raise ValueError(f"Unknown termination: {termination}")
     # perform optimization
     print("Optimization in progress ...!")
+    callback = ProgressCallback(job, n_max_gen=generations, n_snapshots=n_snapshots)
     res = minimize(
-        problem, algorithm, termination, seed=1, save_history=True, verbose=verbose
+        problem,
+        algorithm,
+        criterion,
+        seed=1,
+        callback=callback,
+        save_history=False,
+        verbose=verbose,
     )
     # return results
-    print("Optimization finished!")
-    df_res = pd.DataFrame(res.F, columns=["ER", "EV"])
+    reason = getattr(res.algorithm.termination, "reason", "n_max_gen")
+    print(f"Optimization finished after {res.algorithm.n_gen} generations ({reason})!")
+    # res.F and res.X are None when no feasible solution was found
+    F = res.F if res.F is not None else np.empty((0, problem.n_obj))
+    df_res = pd.DataFrame(F, columns=["ER", "EV", "CVaR"][: problem.n_obj])
     df_res["ER"] = df_res["ER"] * -1
     df_res["SR"] = df_res["ER"] / df_res["EV"]
+    if scenarios is not None:
+        df_res = df_res[["ER", "EV", "SR", "CVaR"]]
+    df_res.attrs.update(n_gen=res.algorithm.n_gen, termination=reason)
+    if res.algorithm.callback.snapshots is not None:
+        df_res.attrs["snapshots"] = list(res.algorithm.callback.snapshots)
     return df_res, res.X
 
 
-def process_portfolio(portfolio):
+def nsga2_algorithm(population, n_var, X0=None, seed=1):
+    """
+    NSGA2 set up for the portfolio problem, optionally warm-started from X0
+    """
+    return NSGA2(
+        pop_size=population,
+        n_offsprings=30,
+        sampling=(
+            get_sampling("real_random")
+            if X0 is None
+            else warm_start_sampling(X0, population, n_var, seed)
+        ),
+        crossover=get_crossover("real_sbx", prob=0.9, eta=15),
+        mutation=get_mutation("real_pm", eta=20),
+        eliminate_duplicates=True,
+    )
+
+
+def run_island(
+    er, cov, population, generations, seed, X0=None, scenarios=None, cvar_level=0.95
+):
+    """
+    Run one NSGA2 island. Returns its final population (X, F, feasible).
+    """
+    problem = PortfolioProblem(
+        er, cov, constr_eq_eps=2e-02, scenarios=scenarios, cvar_level=cvar_level
+    )
+    res = minimize(
+        problem,
+        nsga2_algorithm(population, len(er), X0, seed),
+        get_termination("n_gen", generations),
+        seed=seed,
+        save_history=False,
+    )
+    pop = res.pop
+    return pop.get("X"), pop.get("F"), pop.get("feasible")[:, 0]
+
+
+def elites(X, F, feasible, n):
+    """
+    Up to n feasible non-dominated solutions spread along the front
+    """
+    X, F = X[feasible], F[feasible]
+    if len(X) == 0:
+        return X
+    front = NonDominatedSorting().do(F, only_non_dominated_front=True)
+    front = front[np.argsort(F[front, 0])]
+    return X[front[np.linspace(0, len(front) - 1, min(n, len(front))).astype(int)]]
+
+
+def merge_fronts(X, F):
+    """
+    Non-dominated solutions of the union of several fronts, empty (0, n)
+    arrays if none of them has a solution
+    """
+    if len(F) == 0:
+        return X, F
+    X, unique = np.unique(X, axis=0, return_index=True)
+    F = F[unique]
+    front = NonDominatedSorting().do(F, only_non_dominated_front=True)
+    return X[front], F[front]
+
+
+def island_model(
+    er,
+    cov,
+    population=100,
+    generations=1000,
+    n_islands=4,
+    migration_interval=None,
+    n_migrants=5,
+    max_workers=None,
+    scenarios=None,
+    cvar_level=0.95,
+):
+    """
+    Run n_islands independent NSGA2 islands with different seeds in a
+    process pool and merge their feasible fronts. With migration_interval
+    the islands are synchronized every migration_interval generations and
+    each one receives n_migrants elites of its neighbour (ring topology).
+    """
+    epoch_gens = migration_interval or generations
+    pops = [None] * n_islands
+    X_all, F_all = [], []
+    max_workers = max_workers or min(n_islands, os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        done = 0
+        while done < generations:
+            n_gen = min(epoch_gens, generations - done)
+            seeds = [1 + i + done * n_islands for i in range(n_islands)]
+            results = list(
+                pool.map(
+                    run_island,
+                    [er] * n_islands,
+                    [cov] * n_islands,
+                    [population] * n_islands,
+                    [n_gen] * n_islands,
+                    seeds,
+                    pops,
+                    [scenarios] * n_islands,
+                    [cvar_level] * n_islands,
+                )
+            )
+            done += n_gen
+            # island i continues from its population plus elites of island i - 1
+            pops = [
+                np.vstack([elites(*results[i - 1], n_migrants), results[i][0]])[
+                    :population
+                ]
+                for i in range(n_islands)
+            ]
+    for X, F, feasible in results:
+        X_all.append(X[feasible])
+        F_all.append(F[feasible])
+    return merge_fronts(np.vstack(X_all), np.vstack(F_all))[0]
+
+
+def warm_start_sampling(X0, population, n_var, seed=1):
+    """
+    Initial population made of the solutions in X0 padded with random individuals
+    """
+    X0 = np.clip(np.asarray(X0, dtype=float)[:population], 0, 1)
+    rng = np.random.default_rng(seed)
+    return np.vstack([X0, rng.random((population - len(X0), n_var))])
+
+
+def frontier_results(X, er, Cov, scenarios=None, cvar_level=0.95):
+    """
+    Build the df_res frame (ER, EV, SR and CVaR with scenarios) for a matrix
+    of solutions
+    """
+    ER = expected_return_batch(X, np.asarray(er, dtype=float))
+    EV = expected_vol_batch(X, as_covariance(Cov))
+    df_res = pd.DataFrame({"ER": ER, "EV": EV, "SR": ER / EV})
+    if scenarios is not None:
+        df_res["CVaR"] = cvar_batch(X, scenarios, cvar_level)
+    return df_res
+
+
+def process_portfolio(
+    portfolio,
+    warm_start=True,
+    termination=None,
+    max_time=None,
+    cov="sample",
+    cvar=None,
+):
     """
-    Process the portfolio and optimize
+    Process the portfolio and optimize, returning the packed result of
+    pack_portfolio_result. With warm_start the optimization starts from the
+    last Pareto set stored for the same tickers. termination is passed to
+    Optimize: by default a cold run uses all generations and a warm-started
+    one stops once the front stagnates. cov selects the covariance
+    estimator of getStats. cvar ("historical" or "bootstrap") adds the CVaR
+    of the scenario_matrix of df_pct as a third objective.
     """
+    job = get_current_job()
+    report_stage(job, "fetching")
     df_list = []
     df_list_full = {}
-    for key, val in portfolio.items():
-        tmp, tmp_full = gethistory(key)
+    with timer("gethistory", job):
+        histories = gethistories(portfolio)
+    for key, (tmp, tmp_full) in zip(portfolio, histories):
         df_list.append(tmp)
         df_list_full[key] = tmp_full
-    df = reduce(lambda x, y: pd.merge(x, y, on="Date"), df_list)
+    with timer("merge", job):
+        df = PricePanel.from_frames(df_list).to_frame()
 
     # find total money invested in each stock
     allocation = []
     for key, value in portfolio.items():
         allocation.append(value * df.iloc[-1][key])
 
-    df_pct = getPercentChange(portfolio, df)
+    report_stage(job, "statistics")
+    with timer("getPercentChange", job):
+        df_pct = getPercentChange(portfolio, df)
 
-    df_stat, Corr, Cov = getStats(portfolio, df_pct)
+    with timer("getStats", job):
+        df_stat, Corr, Cov = getStats(portfolio, df_pct, cov=cov)
 
     # current weights
     allocated_weights = np.array(allocation) / np.array(allocation).sum()
@@ -162,83 +721,177 @@ def process_portfolio(portfolio):
     exp_vol = expected_vol(allocated_weights, Cov)
     # Sharpe ratio
     SR = exp_ret / exp_vol
+    scenarios = None if cvar is None else scenario_matrix(df_pct, cvar, rng=1)
     # Monte carlo simulation
-    df_mc = getMC(portfolio, df_pct, df_stat, Cov, n=5000)
-    df_res, X = Optimize(
-        portfolio, df_stat, Cov, population=100, generations=1000, verbose=False
-    )
+    report_stage(job, "monte_carlo")
+    with timer("getMC", job):
+        df_mc = getMC(portfolio, df_pct, df_stat, Cov, n=5000)
+    report_stage(job, "optimizing")
+    X0 = None
+    if warm_start and job is not None:
+        X0 = load_front(job.connection, portfolio)
+    with timer("Optimize", job):
+        df_res, X = Optimize(
+            portfolio,
+            df_stat,
+            Cov,
+            population=100,
+            generations=1000,
+            verbose=False,
+            X0=X0,
+            termination=termination,
+            max_time=max_time,
+            job=job,
+            scenarios=scenarios,
+        )
+    if job is not None:
+        save_front(job.connection, portfolio, X)
     output = {
         "df_mc": df_mc,
         "df_res": df_res,
         "exp_vol": exp_vol,
         "exp_ret": exp_ret,
-        "df_pct": df_pct,
-        "df_stat": df_pct,
-        "Corr": Corr,
-        "Cov": Cov,
-        "X": X,
+        # an empty Pareto set when no feasible solution was found
+        "X": X if X is not None else np.empty((0, len(portfolio))),
         "allocation": allocation,
         "allocated_weights": allocated_weights,
+        "n_gen": df_res.attrs["n_gen"],
+        "termination": df_res.attrs["termination"],
     }
-    return (output, df_list_full, df_stat)
-
-
-def Solutions(df_res, X, portfolio, allocation, allocated_weights, idx):
-
-    if idx == -1:
-        main_df = pd.DataFrame(
-            {
-                "Stock": portfolio.keys(),
-                "Quantity": portfolio.values(),
-                "Last Price ($)": (
-                    np.array(allocation) / np.array(list(portfolio.values()))
-                ).round(2),
-                "Value ($)": np.array(allocation).astype(int),
-                "Portfolio Weights (%)": np.array(allocated_weights * 100).round(1),
-            }
-        )
-        unformatted_df = main_df.copy()
-        main_df["Value ($)"] = ["$ " + str(i) for i in main_df["Value ($)"].tolist()]
-        main_df["Last Price ($)"] = [
-            "$ " + str(i) for i in main_df["Last Price ($)"].tolist()
-        ]
-        main_df["Portfolio Weights (%)"] = [
-            "% " + str(i) for i in main_df["Portfolio Weights (%)"].tolist()
-        ]
-    else:
-        # add selected solution
-        selected_solution = X[idx] / X[idx].sum()
-        # Sharpe solution
-        main_df = pd.DataFrame(
-            {
-                "Stock": portfolio.keys(),
-                "Quantity": portfolio.values(),
-                "Last Price ($)": (
-                    np.array(allocation) / np.array(list(portfolio.values()))
-                ).round(2),
-                "Value ($)": np.array(allocation).astype(int),
-                "Portfolio Weights (%)": np.array(allocated_weights * 100).round(1),
-                "Weights of Selected Solution (%)": np.array(
-                    selected_solution * 100
-                ).round(1),
-                "Values of Selected Solution ($)": np.array(
-                    selected_solution * sum(allocation)
-                ).astype(int),
-            }
+    if scenarios is not None:
+        output["exp_cvar"] = float(cvar_batch(allocated_weights[None], scenarios)[0])
+    return pack_portfolio_result(portfolio, output, df_list_full, df_stat)
+
+
+def pack_portfolio_result(portfolio, output, histories, df_stat, store=None):
+    """
+    Compact job result of process_portfolio (see results.pack_result): frames
+    become dicts of column arrays, and the price histories are references
+    (first and last date) into the price store when one is set
+    """
+    store = store or get_store()
+    data = {
+        "portfolio": {
+            "tickers": np.array(list(portfolio)),
+            "quantities": np.array(list(portfolio.values())),
+        },
+        "output": {
+            key: (
+                {c: value[c].to_numpy() for c in value}
+                if isinstance(value, pd.DataFrame)
+                else value
+            )
+            for key, value in output.items()
+        },
+        "df_stat": {c: df_stat[c].to_numpy() for c in df_stat},
+    }
+    key = "histories" if store is None else "history_refs"
+    data[key] = {}
+    for i, history in enumerate(histories.values()):
+        if store is None:
+            data[key][str(i)] = to_records(history)
+        else:
+            dates = history.index.asi8
+            data[key][str(i)] = np.array([dates[0], dates[-1]])
+    return pack_result(data)
+
+
+def prepare_universe(tickers):
+    """
+    Fetch the histories of every ticker of a batch once for all its
+    portfolios (see optimize_batch_portfolio). Tickers that cannot be
+    fetched are left out and listed in "failed" with their error, only the
+    portfolios holding them fail.
+    """
+    job = get_current_job()
+    tickers = list(tickers)
+    with timer("gethistory", job):
+        histories = gethistories(tickers, return_exceptions=True)
+    failed = {
+        ticker: f"{type(error).__name__}: {error}"
+        for ticker, error in zip(tickers, histories)
+        if isinstance(error, Exception)
+    }
+    closes = {
+        ticker: history[0]
+        for ticker, history in zip(tickers, histories)
+        if ticker not in failed
+    }
+    if not closes:
+        raise ValueError(f"No price history could be fetched: {failed}")
+    return {"tickers": list(closes), "closes": closes, "failed": failed}
+
+
+def universe_portfolio(universe, portfolio, cov="sample", job=None):
+    """
+    Aligned closes, statistics and covariance of one portfolio from the
+    histories of a prepare_universe result. The closes are aligned on the
+    dates of the portfolio's own tickers, so the statistics are the ones
+    process_portfolio computes whichever other tickers the batch holds.
+    """
+    missing = [ticker for ticker in portfolio if ticker not in universe["closes"]]
+    if missing:
+        errors = "; ".join(
+            universe["failed"].get(ticker, "not fetched") for ticker in missing
         )
-        unformatted_df = main_df.copy()
-        main_df["Value ($)"] = ["$ " + str(i) for i in main_df["Value ($)"].tolist()]
-        main_df["Last Price ($)"] = [
-            "$ " + str(i) for i in main_df["Last Price ($)"].tolist()
-        ]
-        main_df["Values of Selected Solution ($)"] = [
-            "$ " + str(i) for i in main_df["Values of Selected Solution ($)"].tolist()
-        ]
-        main_df["Portfolio Weights (%)"] = [
-            "% " + str(i) for i in main_df["Portfolio Weights (%)"].tolist()
-        ]
-        main_df["Weights of Selected Solution (%)"] = [
-            "% " + str(i) for i in main_df["Weights of Selected Solution (%)"].tolist()
-        ]
-    return main_df, unformatted_df
+        raise ValueError(f"No price history for {', '.join(missing)} ({errors})")
+    with timer("merge", job):
+        df = PricePanel.from_frames(
+            [universe["closes"][ticker] for ticker in portfolio]
+        ).to_frame()
+    if len(df) < 2:
+        raise ValueError(f"Not enough common dates for {', '.join(portfolio)}")
+    with timer("getPercentChange", job):
+        df_pct = getPercentChange(portfolio, df)
+    with timer("getStats", job):
+        df_stat, _, Cov = getStats(portfolio, df_pct, cov=cov)
+    return df, df_stat, Cov
+
 
+def optimize_batch_portfolio(
+    universe_id,
+    portfolio_id,
+    portfolio,
+    engine="qp",
+    population=100,
+    generations=1000,
+    cov="sample",
+):
+    """
+    Optimize one portfolio of a batch with the histories fetched by the
+    prepare_universe job universe_id. Returns a JSON-serializable summary.
+    """
+    job = get_current_job()
+    universe = Job.fetch(universe_id, connection=job.connection).result
+    df, df_stat, Cov = universe_portfolio(universe, portfolio, cov=cov, job=job)
+    allocation = np.array(list(portfolio.values())) * df.iloc[-1][list(portfolio)]
+    allocated_weights = allocation.to_numpy(dtype=float) / allocation.sum()
+    exp_vol = expected_vol_batch(allocated_weights[None], as_covariance(Cov))[0]
+    with timer("Optimize", job):
+        df_res, X = Optimize(
+            portfolio,
+            df_stat,
+            Cov,
+            population=population,
+            generations=generations,
+            engine=engine,
+        )
+    if X is None or len(X) == 0:
+        raise ValueError("no feasible Pareto solution found")
+    weights = X / X.sum(axis=1, keepdims=True)
+    return {
+        "id": portfolio_id,
+        "as_of": str(df.index[-1].date()),
+        "tickers": list(portfolio),
+        "pareto": {c: df_res[c].tolist() for c in ["ER", "EV", "SR"]},
+        "weights": weights.round(6).tolist(),
+        "stats": {
+            "ER": df_stat["ER"].tolist(),
+            "Volitility": df_stat["Volitility"].tolist(),
+        },
+        "current": {
+            "weights": allocated_weights.tolist(),
+            "exp_ret": float(allocated_weights @ df_stat["ER"].to_numpy()),
+            "exp_vol": float(exp_vol),
+        },
+    }
@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+
+
+class PricePanel:
+    """
+    Close prices of several stocks on one date index, stored as a contiguous
+    (dates x stocks) float array
+    """
+
+    def __init__(self, dates, tickers, values):
+        self.dates = dates
+        self.tickers = list(tickers)
+        self.values = np.ascontiguousarray(values, dtype=float)
+
+    @classmethod
+    def from_frames(cls, frames):
+        """
+        Align single-column close price frames on the dates they all share
+        (like an inner merge on "Date") in one pass
+        """
+        indexes = [frame.index for frame in frames]
+        # UTC nanoseconds since epoch
+        stamps = [
+            index.values.astype("datetime64[ns]").astype("i8") for index in indexes
+        ]
+        # dates present in every frame
+        unique, counts = np.unique(
+            np.concatenate([np.unique(stamp) for stamp in stamps]), return_counts=True
+        )
+        common = unique[counts == len(frames)]
+        values = np.empty((len(common), len(frames)))
+        for j, (frame, stamp) in enumerate(zip(frames, stamps)):
+            order = np.argsort(stamp, kind="stable")
+            rows = order[np.searchsorted(stamp, common, sorter=order)]
+            values[:, j] = frame.iloc[:, 0].to_numpy(dtype=float)[rows]
+        dates = pd.DatetimeIndex(common.astype("datetime64[ns]"), name="Date")
+        if indexes[0].tz is not None:
+            dates = dates.tz_localize("UTC").tz_convert(indexes[0].tz)
+        tickers = [frame.columns[0] for frame in frames]
+        return cls(dates, tickers, values)
+
+    def to_frame(self):
+        return pd.DataFrame(self.values, index=self.dates, columns=self.tickers)
+
+    def log_returns(self):
+        return log_returns(self.values)
+
+
+def log_returns(values):
+    """
+    Log of daily percentage change of a (dates x stocks) array; the first
+    row is NaN like pandas pct_change
+    """
+    out = np.empty_like(values, dtype=float)
+    out[0] = np.nan
+    np.log(values[1:] / values[:-1], out=out[1:])
+    return out
+
+
+def return_stats(R, n=None):
+    """
+    Mean, variance, covariance and correlation of the rows of a (dates x
+    stocks) log return array without NaN rows. n is the number of periods
+    used to annualize (defaults to the number of rows).
+    """
+    n = len(R) if n is None else n
+    mean = R.mean(axis=0)
+    centered = R - mean
+    cov = centered.T @ centered / (len(R) - 1)
+    std = np.sqrt(np.diag(cov))
+    corr = cov / np.outer(std, std)
+    return {
+        "Mean": mean,
+        "Var": np.diag(cov).copy(),
+        "Std": std,
+        "Volitility": std * np.sqrt(n),
+        "ER": mean * n,
+        "Corr": corr,
+        "Cov": cov * n,
+    }
+
+
+class RollingStats:
+    """
+    Mean and covariance of the rows of a rolling window of log returns,
+    updated in O(n^2) per day with rank-1 updates (Welford) as rows enter
+    and leave the window instead of being recomputed from the window
+    """
+
+    def __init__(self, R):
+        R = np.asarray(R, dtype=float)
+        self.count = len(R)
+        self.mean = R.mean(axis=0)
+        centered = R - self.mean
+        # sum of outer products of the deviations from the mean
+        self.m2 = centered.T @ centered
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 += np.outer(delta, x - self.mean)
+
+    def remove(self, x):
+        mean = (self.count * self.mean - x) / (self.count - 1)
+        self.m2 -= np.outer(x - mean, x - self.mean)
+        self.mean = mean
+        self.count -= 1
+
+    def roll(self, x_in, x_out):
+        """
+        Slide the window by one row: x_in enters, x_out leaves
+        """
+        self.add(x_in)
+        self.remove(x_out)
+
+    def stats(self, n=None):
+        """
+        Statistics of the window in the format of return_stats
+        """
+        n = self.count if n is None else n
+        cov = self.m2 / (self.count - 1)
+        std = np.sqrt(np.diag(cov))
+        return {
+            "Mean": self.mean.copy(),
+            "Var": np.diag(cov).copy(),
+            "Std": std,
+            "Volitility": std * np.sqrt(n),
+            "ER": self.mean * n,
+            "Corr": cov / np.outer(std, std),
+            "Cov": cov * n,
+        }
@@ -4,6 +4,7 @@ from bokeh.io import show, output_notebook
 from bokeh.models import (
     ColumnDataSource,
     CrosshairTool,
+    LogColorMapper,
     Select,
     CustomJS,
 )
@@ -11,29 +12,116 @@ from bokeh.models.tools import HoverTool
 from bokeh.transform import transform, dodge
 from bokeh.layouts import layout, column, row
 from bokeh.embed import components
+from bokeh.palettes import Greys256
 import numpy as np
 
+# Monte Carlo clouds up to this size are drawn point by point in "auto" mode
+MC_POINTS = 5000
+# bins of the density image along (EV, ER) and of the envelope along EV
+MC_BINS = (150, 75)
 
-def plotPareto(df_mc, df_res, exp_vol, exp_ret, idx):
+
+def as_columns(table):
+    """
+    Columns of a DataFrame or of a dict of arrays (packed job results) as a
+    dict of numpy arrays
+    """
+    return {name: np.asarray(values) for name, values in table.items()}
+
+
+def mc_density(df_mc, bins=MC_BINS):
+    """
+    2-D histogram of the Monte Carlo cloud (in %) on an (EV, ER) grid.
+    Returns the counts (ER rows x EV columns, NaN where empty) and the
+    extent x, y, dw, dh of the image.
+    """
+    ev, er = np.asarray(df_mc["EV"]) * 100, np.asarray(df_mc["ER"]) * 100
+    H, xedges, yedges = np.histogram2d(ev, er, bins=bins)
+    H = H.T.astype(np.float32)
+    H[H == 0] = np.nan
+    extent = (xedges[0], yedges[0], xedges[-1] - xedges[0], yedges[-1] - yedges[0])
+    return H, extent
+
+
+def mc_envelope(df_mc, bins=MC_BINS[0]):
+    """
+    Lowest and highest ER (in %) of the Monte Carlo cloud in each EV bin
+    """
+    ev, er = np.asarray(df_mc["EV"]) * 100, np.asarray(df_mc["ER"]) * 100
+    edges = np.linspace(ev.min(), ev.max(), bins + 1)
+    which = np.clip(np.searchsorted(edges, ev, side="right") - 1, 0, bins - 1)
+    lower = np.full(bins, np.inf)
+    upper = np.full(bins, -np.inf)
+    np.minimum.at(lower, which, er)
+    np.maximum.at(upper, which, er)
+    filled = np.isfinite(lower)
+    centers = (edges[:-1] + edges[1:]) / 2
+    return {"EV": centers[filled], "lower": lower[filled], "upper": upper[filled]}
+
+
+def plotPareto(df_mc, df_res, exp_vol, exp_ret, idx, mc="auto"):
     """
-    This function will plot pareto front
+    This function will plot pareto front. mc selects how the Monte Carlo
+    cloud is drawn: "points", "density" (binned image), "envelope" (band
+    between the lowest and highest returns) or "auto" (points up to
+    MC_POINTS portfolios, density above).
     """
+    df_mc, df_res = as_columns(df_mc), as_columns(df_res)
     # filter df_mc
-    df_mc = df_mc[df_mc["EV"] <= df_res["EV"].max()]
+    if len(df_res["EV"]):
+        keep = df_mc["EV"] <= df_res["EV"].max()
+        df_mc = {name: values[keep] for name, values in df_mc.items()}
+    if mc == "auto":
+        mc = "points" if len(df_mc["EV"]) <= MC_POINTS else "density"
     p = figure(plot_width=600, plot_height=300)
     # add a circle renderer with a size, color, and alpha
-    source0 = ColumnDataSource(df_mc * 100)
-    source = ColumnDataSource(df_res * 100)
-    p.circle(
-        x="EV",
-        y="ER",
-        source=source0,
-        size=2,
-        color="grey",
-        alpha=0.95,
-        name="Monte Carlo Simulation",
-        legend_label="Monte Carlo Simulation",
-    )
+    data = {name: values * 100 for name, values in df_res.items()}
+    data["index"] = np.arange(len(df_res["EV"]))
+    source = ColumnDataSource(data)
+    if mc == "points":
+        source0 = ColumnDataSource({k: v * 100 for k, v in df_mc.items()})
+        p.circle(
+            x="EV",
+            y="ER",
+            source=source0,
+            size=2,
+            color="grey",
+            alpha=0.95,
+            name="Monte Carlo Simulation",
+            legend_label="Monte Carlo Simulation",
+        )
+    elif mc == "density":
+        H, (x, y, dw, dh) = mc_density(df_mc)
+        # dense bins are darker, empty bins transparent
+        mapper = LogColorMapper(
+            palette=list(reversed(Greys256[:200])),
+            nan_color=(0, 0, 0, 0),
+            low=1,
+            high=float(np.nanmax(H)),
+        )
+        p.image(
+            image=[H],
+            x=x,
+            y=y,
+            dw=dw,
+            dh=dh,
+            color_mapper=mapper,
+            name="Monte Carlo Simulation",
+            legend_label="Monte Carlo Simulation",
+        )
+    elif mc == "envelope":
+        p.varea(
+            x="EV",
+            y1="lower",
+            y2="upper",
+            source=ColumnDataSource(mc_envelope(df_mc)),
+            color="grey",
+            alpha=0.5,
+            name="Monte Carlo Simulation",
+            legend_label="Monte Carlo Simulation",
+        )
+    else:
+        raise ValueError(f"Unknown Monte Carlo rendering mode: {mc}")
     p.circle(
         x="EV",
         y="ER",
@@ -46,8 +134,8 @@ def plotPareto(df_mc, df_res, exp_vol, exp_ret, idx):
     )
     if idx != -1:
         p.scatter(
-            df_res.loc[idx, "EV"] * 100,
-            df_res.loc[idx, "ER"] * 100,
+            df_res["EV"][idx] * 100,
+            df_res["ER"][idx] * 100,
             size=15,
             color="blue",
             alpha=0.9,
@@ -66,8 +154,11 @@ def plotPareto(df_mc, df_res, exp_vol, exp_ret, idx):
         legend_label="Current Position",
         marker="square",
     )
+    tooltips = [("Index", "@index"), ("Return", "@ER"), ("Volitility", "@EV")]
+    if "CVaR" in df_res:
+        tooltips.append(("CVaR", "@CVaR"))
     hover = HoverTool(
-        tooltips=[("Index", "@index"), ("Return", "@ER"), ("Volitility", "@EV")],
+        tooltips=tooltips,
         names=["Pareto Front"],
         mode="mouse",
     )
@@ -161,139 +252,112 @@ def plotWeights(unformatted_df, idx):
     return p
 
 
-def get_layout(stocks_histories):
+# most candles drawn for one ticker; longer histories are merged into
+# multi-day candles
+MAX_POINTS = 1000
+
+
+def history_columns(history, max_points=MAX_POINTS):
     """
-    This function prepares plot of stock daily time histories
+    Chart columns of one OHLC history as numpy arrays: "all" (dates in ms
+    since epoch, high, low) for the wicks and "inc"/"dec" (dates, open,
+    close, width) for the rising and falling candles. Histories longer than
+    max_points rows are downsampled into candles of several days.
     """
-    # create a dictionary of the date
-    data = dict()
-    for key, value in stocks_histories.items():
-        key_date = key + "_date"
-        value_date = value.index.tolist()
-        key_open = key + "_open"
-        value_open = value["Open"].tolist()
-        key_close = key + "_close"
-        value_close = value["Close"].tolist()
-        key_high = key + "_high"
-        value_high = value["High"].tolist()
-        key_low = key + "_low"
-        value_low = value["Low"].tolist()
-        data[key_date] = value_date
-        data[key_open] = value_open
-        data[key_close] = value_close
-        data[key_high] = value_high
-        data[key_low] = value_low
-    # add active cases
-    data["active_date"] = data[key_date]
-    data["active_open"] = data[key_open]
-    data["active_close"] = data[key_close]
-    data["active_high"] = data[key_high]
-    data["active_low"] = data[key_low]
-    # add inc and dec cases
-    inc_date = []
-    inc_open = []
-    inc_close = []
-    dec_date = []
-    dec_open = []
-    dec_close = []
-    for i in range(len(data["active_open"])):
-        if data["active_open"][i] < data["active_close"][i]:
-            inc_date.append(data["active_date"][i])
-            inc_open.append(data["active_open"][i])
-            inc_close.append(data["active_close"][i])
-            dec_date.append(math.nan)
-            dec_open.append(math.nan)
-            dec_close.append(math.nan)
-        else:
-            dec_date.append(data["active_date"][i])
-            dec_open.append(data["active_open"][i])
-            dec_close.append(data["active_close"][i])
-            inc_date.append(math.nan)
-            inc_open.append(math.nan)
-            inc_close.append(math.nan)
-    data["inc_date"] = inc_date
-    data["inc_open"] = inc_open
-    data["inc_close"] = inc_close
-    data["dec_date"] = dec_date
-    data["dec_open"] = dec_open
-    data["dec_close"] = dec_close
-    source = ColumnDataSource(data=data)
+    if hasattr(history, "index"):
+        date = history.index.asi8 / 1e6
+    else:
+        # PriceStore records, dates in UTC nanoseconds
+        date = history["Date"] / 1e6
+    o, h, l, c = (
+        np.asarray(history[k], dtype=float) for k in ["Open", "High", "Low", "Close"]
+    )
+    step = 1 if not max_points else max(1, math.ceil(len(date) / max_points))
+    if step > 1:
+        starts = np.arange(0, len(date), step)
+        date, o, c = date[starts], o[starts], c[np.minimum(starts + step, len(c)) - 1]
+        h, l = np.maximum.reduceat(h, starts), np.minimum.reduceat(l, starts)
+    # half of the typical spacing of the candles
+    width = np.full(
+        len(date), 0.5 * (np.median(np.diff(date)) if len(date) > 1 else 864e5)
+    )
+    inc = o < c
+    return {
+        "all": {"date": date, "high": h, "low": l},
+        "inc": {
+            "date": date[inc],
+            "open": o[inc],
+            "close": c[inc],
+            "width": width[inc],
+        },
+        "dec": {
+            "date": date[~inc],
+            "open": o[~inc],
+            "close": c[~inc],
+            "width": width[~inc],
+        },
+    }
+
+
+def get_layout(stocks_histories, url=None, max_points=MAX_POINTS):
+    """
+    This function prepares plot of stock daily time histories. Only the
+    history of the selected ticker is embedded; other tickers are fetched
+    from url (with "__ticker__" in place of the ticker) when selected, or
+    embedded too when no url is given.
+    """
+    key = list(stocks_histories)[-1]
+    columns = history_columns(stocks_histories[key], max_points)
+    sources = {part: ColumnDataSource(data=data) for part, data in columns.items()}
     select = Select(
         title="Select a ticker:", value=key, options=list(stocks_histories.keys())
     )
+    if url is None:
+        # one source per ticker and part, parts have different lengths
+        store = {
+            f"{ticker}:{part}": ColumnDataSource(data=data)
+            for ticker, history in stocks_histories.items()
+            for part, data in history_columns(history, max_points).items()
+        }
+        code = """
+      for (const part in sources) {
+        sources[part].data = Object.assign({}, store[select.value + ':' + part].data)
+      }
+      """
+    else:
+        store = None
+        code = """
+      fetch(url.replace('__ticker__', encodeURIComponent(select.value)))
+        .then(response => response.json())
+        .then(columns => {
+          for (const part in sources) {
+            sources[part].data = columns[part]
+          }
+        })
+      """
     select.js_on_change(
         "value",
         CustomJS(
-            args=dict(source=source, select=select),
-            code="""
-      var val_date = select.value + '_date'
-      var val_open = select.value + '_open'
-      var val_close = select.value + '_close'
-      var val_high = select.value + '_high'
-      var val_low = select.value + '_low'
-      source.data['active_date'] = source.data[val_date]
-      source.data['active_open'] = source.data[val_open]
-      source.data['active_close'] = source.data[val_close]
-      source.data['active_high'] = source.data[val_high]
-      source.data['active_low'] = source.data[val_low]
-      var inc_date = []
-      var inc_open = []
-      var inc_close = []
-      var dec_date = []
-      var dec_open = []
-      var dec_close = []
-      for (var i=0; i<source.data['active_open'].length; i++){
-      if (source.data['active_open'][i] < source.data['active_close'][i]) {
-      inc_date.push(source.data['active_date'][i])
-      inc_open.push(source.data['active_open'][i])
-      inc_close.push(source.data['active_close'][i])
-      dec_date.push(Number.NaN)
-      dec_open.push(Number.NaN)
-      dec_close.push(Number.NaN)
-      } else {
-      dec_date.push(source.data['active_date'][i])
-      dec_open.push(source.data['active_open'][i])
-      dec_close.push(source.data['active_close'][i])
-      inc_date.push(Number.NaN)
-      inc_open.push(Number.NaN)
-      inc_close.push(Number.NaN)
-      }
-      }
-      source.data['inc_date'] = inc_date
-      source.data['inc_open'] = inc_open
-      source.data['inc_close'] = inc_close
-      source.data['dec_date'] = dec_date
-      source.data['dec_open'] = dec_open
-      source.data['dec_close'] = dec_close
-      source.change.emit()
-      """,
+            args=dict(sources=sources, select=select, store=store, url=url), code=code
         ),
     )
     p = figure(x_axis_type="datetime", plot_width=600, plot_height=300)
-    p.segment(
-        "active_date",
-        "active_low",
-        "active_date",
-        "active_high",
-        source=source,
-        color="grey",
-    )
-    w = 12 * 60 * 60 * 1000  # half day in ms
+    p.segment("date", "low", "date", "high", source=sources["all"], color="grey")
     p.vbar(
-        "inc_date",
-        w,
-        "inc_open",
-        "inc_close",
-        source=source,
+        "date",
+        "width",
+        "open",
+        "close",
+        source=sources["inc"],
         fill_color="green",
         line_color="green",
     )
     p.vbar(
-        "dec_date",
-        w,
-        "dec_open",
-        "dec_close",
-        source=source,
+        "date",
+        "width",
+        "open",
+        "close",
+        source=sources["dec"],
         fill_color="red",
         line_color="red",
     )
@@ -311,8 +375,9 @@ def get_layout(stocks_histories):
     return layout
 
 
-def plotEvEr(df_statistics):
-    stocks = df_statistics.index.tolist()
+def plotEvEr(df_statistics, stocks=None):
+    if stocks is None:
+        stocks = df_statistics.index.tolist()
     """This function will plot expected return and expected volitility of each stock in the portfolio"""
     data = {
         "stocks": stocks,
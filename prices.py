@@ -0,0 +1,293 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class YahooProvider:
+    """
+    Daily OHLCV histories from Yahoo Finance
+    """
+
+    def history(self, stock, start, timeout=None):
+        # imported here, processes that only read the price store skip it
+        import yfinance as yf
+
+        ticker = yf.Ticker(stock)
+        return ticker.history(start=start, interval="1d", timeout=timeout)
+
+
+class CSVProvider:
+    """
+    Daily OHLCV histories read from <directory>/<stock>.csv (index column "Date")
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def history(self, stock, start, timeout=None):
+        tmp = pd.read_csv(
+            os.path.join(self.directory, stock + ".csv"), index_col="Date"
+        )
+        tmp.index = pd.to_datetime(tmp.index, utc=True)
+        return tmp[tmp.index >= pd.Timestamp(start, tz="UTC")]
+
+
+def get_provider():
+    """
+    Provider selected by the PRICE_PROVIDER_DIR environment variable: a CSV
+    directory when it is set, Yahoo Finance otherwise
+    """
+    directory = os.getenv("PRICE_PROVIDER_DIR")
+    if directory:
+        return CSVProvider(directory)
+    return YahooProvider()
+
+
+def format_history(stock, tmp):
+    """
+    Convert the index to US/Eastern and split off the close prices
+    """
+    tmp.index = pd.to_datetime(tmp.index, utc=True)
+    tmp.index = tmp.index.tz_convert("US/Eastern")
+    tmp.index.name = "Date"
+    return tmp[["Close"]].rename(columns={"Close": stock}), tmp
+
+
+class PriceStore:
+    """
+    On-disk daily OHLCV store with one memory-mapped structured .npy file per
+    stock. Only the days after the last stored date are downloaded again.
+    """
+
+    columns = ["Open", "High", "Low", "Close", "Volume"]
+    dtype = np.dtype([("Date", "i8")] + [(c, "f8") for c in columns])
+
+    def __init__(self, directory, max_age=3600):
+        self.directory = directory
+        # seconds before a stored history is checked for new days again
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, stock):
+        return os.path.join(self.directory, stock + ".npy")
+
+    def load(self, stock):
+        """
+        Memory-mapped records of a stock, or None if it is not stored
+        """
+        try:
+            return np.load(self.path(stock), mmap_mode="r")
+        except FileNotFoundError:
+            return None
+
+    def save(self, stock, records):
+        # write then rename so readers never see a partially written file
+        tmp_path = self.path(stock) + f".{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, records)
+        os.replace(tmp_path, self.path(stock))
+
+    def window(self, stock, start, end=None):
+        """
+        Zero-copy slice of the stored records from start onwards (until end
+        included if given)
+        """
+        records = self.load(stock)
+        if records is None:
+            return None
+        start_ns = pd.Timestamp(start, tz="UTC").value
+        stop = None
+        if end is not None:
+            end_ns = pd.Timestamp(end, tz="UTC").value
+            stop = np.searchsorted(records["Date"], end_ns, side="right")
+        return records[np.searchsorted(records["Date"], start_ns) : stop]
+
+    def update(self, stock, start, download):
+        """
+        Make sure the stored history covers start until today. download(start,
+        allow_empty) returns a raw OHLCV frame starting at start.
+        """
+        records = self.load(stock)
+        # a week of slack so start dates on weekends and holidays count as covered
+        start_ns = (pd.Timestamp(start, tz="UTC") + pd.Timedelta(days=7)).value
+        if records is None or len(records) == 0 or records["Date"][0] > start_ns:
+            self.save(stock, to_records(download(start, False)))
+            return
+        if time.time() - os.path.getmtime(self.path(stock)) < self.max_age:
+            return
+        # re-download the last stored day, it may have been an intraday bar
+        last = pd.Timestamp(records["Date"][-1], tz="UTC")
+        new = to_records(download(last.tz_convert("US/Eastern").date(), True))
+        if len(new):
+            kept = records[records["Date"] < new["Date"][0]]
+            self.save(stock, np.concatenate([kept, new]))
+        else:
+            os.utime(self.path(stock))
+
+    def history(self, stock, start, download):
+        """
+        Stored OHLCV frame of a stock from start onwards, updated if needed
+        """
+        self.update(stock, start, download)
+        records = self.window(stock, start)
+        tmp = pd.DataFrame(
+            {c: records[c] for c in self.columns},
+            index=pd.to_datetime(records["Date"].astype("datetime64[ns]"), utc=True),
+        )
+        tmp.index.name = "Date"
+        return tmp
+
+
+def get_store():
+    """
+    Price store in the PRICE_STORE_DIR directory, None if it is not set.
+    Job results refer to histories in the store, so the web and worker
+    processes must see the same directory (a shared volume).
+    """
+    directory = os.getenv("PRICE_STORE_DIR")
+    if directory:
+        max_age = int(os.getenv("PRICE_STORE_MAX_AGE", 3600))
+        return PriceStore(directory, max_age=max_age)
+    return None
+
+
+def to_nanoseconds(index):
+    """
+    UTC nanoseconds since epoch of a datetime index
+    """
+    index = pd.to_datetime(index, utc=True)
+    return index.tz_convert(None).values.astype("datetime64[ns]").astype("i8")
+
+
+def to_records(tmp):
+    """
+    Convert a raw OHLCV frame into PriceStore records
+    """
+    records = np.empty(len(tmp), dtype=PriceStore.dtype)
+    records["Date"] = to_nanoseconds(tmp.index)
+    for c in PriceStore.columns:
+        records[c] = tmp[c].to_numpy(dtype="f8")
+    return records
+
+
+def history_records(stock, start_ns, end_ns, store=None):
+    """
+    PriceStore records of a stock between two UTC nanosecond timestamps,
+    from the price store or downloaded again if it does not cover them
+    (e.g. when the store is not shared with the worker that wrote the result)
+    """
+    store = store or get_store()
+    records = None if store is None else store.window(stock, start_ns, end_ns)
+    if records is None or len(records) == 0 or records["Date"][0] != start_ns:
+        logger.warning(
+            "Price store %s does not cover %s, downloading its history again",
+            None if store is None else store.directory,
+            stock,
+        )
+        start = pd.Timestamp(start_ns, tz="UTC").tz_convert("US/Eastern").date()
+        records = to_records(fetch_history(stock, start, store=store)[1])
+        records = records[records["Date"] <= end_ns]
+    return records
+
+
+def download(
+    stock, start, provider, timeout=30, retries=2, backoff=1.0, allow_empty=False
+):
+    """
+    Download the raw history of a single stock, retrying failed or empty downloads
+    """
+    for attempt in range(retries + 1):
+        try:
+            tmp = provider.history(stock, start, timeout=timeout)
+            if tmp is None or tmp.empty:
+                if allow_empty:
+                    return pd.DataFrame(columns=PriceStore.columns)
+                raise ValueError(f"No price history returned for {stock}")
+            return tmp
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def fetch_history(
+    stock, start, provider=None, timeout=30, retries=2, backoff=1.0, store=None
+):
+    """
+    Fetch the history of a single stock, through the price store if one is set
+    """
+    provider = provider or get_provider()
+    store = store or get_store()
+    if store is None:
+        return format_history(
+            stock, download(stock, start, provider, timeout, retries, backoff)
+        )
+
+    def download_from(start, allow_empty):
+        return download(
+            stock, start, provider, timeout, retries, backoff, allow_empty
+        )
+
+    return format_history(stock, store.history(stock, start, download_from))
+
+
+def fetch_histories(
+    stocks,
+    start,
+    provider=None,
+    max_workers=8,
+    timeout=30,
+    retries=2,
+    backoff=1.0,
+    store=None,
+    return_exceptions=False,
+):
+    """
+    Fetch the histories of several stocks concurrently. Returns a list of
+    (close_df, full_ohlc) pairs in the order of stocks. With
+    return_exceptions the error of a stock that could not be fetched takes
+    the place of its pair instead of being raised.
+    """
+    provider = provider or get_provider()
+    store = store or get_store()
+    stocks = list(stocks)
+    # upper bound for one stock including all retries and backoff sleeps
+    deadline = (retries + 1) * timeout + backoff * (2 ** retries - 1)
+    pool = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(stocks))))
+    try:
+        futures = [
+            pool.submit(
+                fetch_history,
+                stock,
+                start,
+                provider,
+                timeout,
+                retries,
+                backoff,
+                store,
+            )
+            for stock in stocks
+        ]
+        results = []
+        for stock, future in zip(stocks, futures):
+            try:
+                results.append(future.result(timeout=deadline))
+            except FutureTimeoutError:
+                error = TimeoutError(f"Timed out fetching price history for {stock}")
+                if not return_exceptions:
+                    raise error
+                results.append(error)
+            except Exception as error:
+                if not return_exceptions:
+                    raise
+                results.append(error)
+    finally:
+        # do not block on hung downloads once the job has failed
+        pool.shutdown(wait=False, cancel_futures=True)
+    return results
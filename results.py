@@ -0,0 +1,173 @@
+import io
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# default memory ceiling of a result store (bytes) and lifetime of an entry (s)
+MAX_BYTES = int(os.getenv("RESULT_STORE_MAX_BYTES", 256 * 1024 * 1024))
+TTL = int(os.getenv("RESULT_STORE_TTL", 6 * 60 * 60))
+
+
+# float dtype of packed job results ("float32" halves their size)
+RESULT_DTYPE = os.getenv("RESULT_DTYPE", "float64")
+
+
+def sizeof(value):
+    """
+    Approximate memory footprint of a value (size of its pickle)
+    """
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class LocalResultStore:
+    """
+    In-process job results with LRU eviction, a TTL and a memory ceiling
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, ttl=TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, size, value)
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[2]
+
+    def put(self, key, value):
+        size = sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (time.time() + self.ttl, size, value)
+            self.total += size
+            # evict least recently used entries above the ceiling
+            while self.total > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        self.total -= self.entries.pop(key)[1]
+
+
+class RedisResultStore:
+    """
+    Job results pickled into Redis so every web worker can serve them. A
+    sorted set of access times drives LRU eviction above the memory ceiling.
+    """
+
+    def __init__(self, conn, max_bytes=MAX_BYTES, ttl=TTL, prefix="results"):
+        self.conn = conn
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def get(self, key):
+        blob = self.conn.get(self._key(key))
+        if blob is None:
+            return None
+        self.conn.zadd(self.prefix + ":lru", {key: time.time()})
+        return pickle.loads(blob)
+
+    def put(self, key, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        pipe = self.conn.pipeline()
+        pipe.set(self._key(key), blob, ex=self.ttl)
+        pipe.zadd(self.prefix + ":lru", {key: time.time()})
+        pipe.hset(self.prefix + ":sizes", key, len(blob))
+        pipe.execute()
+        self._evict()
+
+    def _evict(self):
+        lru, sizes = self.prefix + ":lru", self.prefix + ":sizes"
+        # forget entries whose blobs have already expired
+        for key in self.conn.zrangebyscore(lru, 0, time.time() - self.ttl):
+            self._remove(key)
+        total = sum(int(size) for size in self.conn.hvals(sizes))
+        while total > self.max_bytes:
+            oldest = self.conn.zrange(lru, 0, 0)
+            if not oldest:
+                break
+            total -= int(self.conn.hget(sizes, oldest[0]) or 0)
+            self._remove(oldest[0])
+
+    def _remove(self, key):
+        if isinstance(key, bytes):
+            key = key.decode()
+        pipe = self.conn.pipeline()
+        pipe.delete(self._key(key))
+        pipe.zrem(self.prefix + ":lru", key)
+        pipe.hdel(self.prefix + ":sizes", key)
+        pipe.execute()
+
+
+def get_result_store(conn):
+    """
+    Result store selected by the RESULT_STORE environment variable
+    ("local" or "redis")
+    """
+    if os.getenv("RESULT_STORE", "local") == "redis":
+        return RedisResultStore(conn)
+    return LocalResultStore()
+
+
+def flatten(data, prefix=""):
+    """
+    "a/b" -> value pairs of the leaves of nested dicts
+    """
+    for key, value in data.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}/")
+        elif value is not None:
+            yield prefix + str(key), value
+
+
+def pack_result(data, dtype=RESULT_DTYPE):
+    """
+    Serialize nested dicts of numpy arrays, numbers and strings into a
+    compressed .npz blob without pickles. Float arrays are cast to dtype.
+    """
+    arrays = {}
+    for key, value in flatten(data):
+        value = np.asarray(value)
+        if value.dtype.kind == "f" and value.ndim > 0:
+            value = value.astype(dtype, copy=False)
+        arrays[key] = value
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def unpack_result(blob):
+    """
+    Nested dicts of numpy arrays (numbers and strings for scalars) of a
+    blob written by pack_result
+    """
+    data = {}
+    with np.load(io.BytesIO(blob), allow_pickle=False) as npz:
+        for key in npz.files:
+            value = npz[key]
+            *parents, name = key.split("/")
+            node = data
+            for parent in parents:
+                node = node.setdefault(parent, {})
+            node[name] = value.item() if value.ndim == 0 else value
+    return data
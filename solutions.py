@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+
+def select_solution(df_res, idx):
+    """
+    Row of df_res (a DataFrame or a dict of column arrays) for a solution
+    index (-1 for the current portfolio) or a criterion: "max_sharpe",
+    "min_cvar" or "knee", the solution closest to the ideal point of all
+    objectives (ER, EV and CVaR if present) once each is scaled to [0, 1].
+    Raises IndexError for an index outside df_res.
+    """
+    if isinstance(idx, str) and idx.strip().lstrip("-").isdigit():
+        idx = int(idx)
+    if not isinstance(idx, str):
+        idx = int(idx)
+        if idx != -1 and not 0 <= idx < len(np.asarray(df_res["ER"])):
+            raise IndexError(f"No solution {idx}")
+        return idx
+    if idx == "max_sharpe":
+        return int(np.argmax(np.asarray(df_res["SR"])))
+    if idx == "min_cvar" and "CVaR" in df_res:
+        return int(np.argmin(np.asarray(df_res["CVaR"])))
+    if idx == "knee":
+        F = np.column_stack([df_res[c] for c in ["ER", "EV", "CVaR"] if c in df_res])
+        F = F * np.array([-1] + [1] * (F.shape[1] - 1))
+        span = np.ptp(F, axis=0)
+        F = (F - F.min(axis=0)) / np.where(span > 0, span, 1)
+        return int(np.argmin(np.linalg.norm(F, axis=1)))
+    raise ValueError(f"Unknown solution: {idx}")
+
+
+def Solutions(df_res, X, portfolio, allocation, allocated_weights, idx):
+
+    idx = select_solution(df_res, idx)
+    if idx == -1:
+        main_df = pd.DataFrame(
+            {
+                "Stock": portfolio.keys(),
+                "Quantity": portfolio.values(),
+                "Last Price ($)": (
+                    np.array(allocation) / np.array(list(portfolio.values()))
+                ).round(2),
+                "Value ($)": np.array(allocation).astype(int),
+                "Portfolio Weights (%)": np.array(allocated_weights * 100).round(1),
+            }
+        )
+        unformatted_df = main_df.copy()
+        main_df["Value ($)"] = ["$ " + str(i) for i in main_df["Value ($)"].tolist()]
+        main_df["Last Price ($)"] = [
+            "$ " + str(i) for i in main_df["Last Price ($)"].tolist()
+        ]
+        main_df["Portfolio Weights (%)"] = [
+            "% " + str(i) for i in main_df["Portfolio Weights (%)"].tolist()
+        ]
+    else:
+        # add selected solution
+        selected_solution = X[idx] / X[idx].sum()
+        # Sharpe solution
+        main_df = pd.DataFrame(
+            {
+                "Stock": portfolio.keys(),
+                "Quantity": portfolio.values(),
+                "Last Price ($)": (
+                    np.array(allocation) / np.array(list(portfolio.values()))
+                ).round(2),
+                "Value ($)": np.array(allocation).astype(int),
+                "Portfolio Weights (%)": np.array(allocated_weights * 100).round(1),
+                "Weights of Selected Solution (%)": np.array(
+                    selected_solution * 100
+                ).round(1),
+                "Values of Selected Solution ($)": np.array(
+                    selected_solution * sum(allocation)
+                ).astype(int),
+            }
+        )
+        unformatted_df = main_df.copy()
+        main_df["Value ($)"] = ["$ " + str(i) for i in main_df["Value ($)"].tolist()]
+        main_df["Last Price ($)"] = [
+            "$ " + str(i) for i in main_df["Last Price ($)"].tolist()
+        ]
+        main_df["Values of Selected Solution ($)"] = [
+            "$ " + str(i) for i in main_df["Values of Selected Solution ($)"].tolist()
+        ]
+        main_df["Portfolio Weights (%)"] = [
+            "% " + str(i) for i in main_df["Portfolio Weights (%)"].tolist()
+        ]
+        main_df["Weights of Selected Solution (%)"] = [
+            "% " + str(i) for i in main_df["Weights of Selected Solution (%)"].tolist()
+        ]
+    return main_df, unformatted_df
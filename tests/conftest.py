@@ -0,0 +1,65 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TICKERS = ["AAA", "BBB", "CCC"]
+
+
+def write_histories(directory, tickers, n_days=500, seed=0):
+    """
+    Write correlated random-walk OHLCV histories ending today as
+    <directory>/<ticker>.csv files, the format read by prices.CSVProvider.
+    BBB misses a few days so that merging has to align the dates.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(
+        end=pd.Timestamp.today().normalize(),
+        periods=n_days,
+        tz="US/Eastern",
+        name="Date",
+    )
+    market = rng.normal(0.0003, 0.01, (n_days, 1))
+    log_ret = market + rng.normal(0.0002, 0.015, (n_days, len(tickers)))
+    close = 100 * np.exp(np.cumsum(log_ret, axis=0))
+    for i, ticker in enumerate(tickers):
+        open_ = close[:, i] * np.exp(rng.normal(0, 0.005, n_days))
+        spread = np.abs(rng.normal(0, 0.01, n_days))
+        tmp = pd.DataFrame(
+            {
+                "Open": open_,
+                "High": np.maximum(open_, close[:, i]) * (1 + spread),
+                "Low": np.minimum(open_, close[:, i]) * (1 - spread),
+                "Close": close[:, i],
+                "Volume": rng.integers(1000, 100000, n_days).astype(float),
+            },
+            index=dates,
+        )
+        if ticker == "BBB":
+            tmp = tmp.drop(dates[[-40, -100, -101]])
+        tmp.to_csv(os.path.join(directory, ticker + ".csv"))
+
+
+@pytest.fixture
+def price_dir(tmp_path, monkeypatch):
+    """
+    Directory of CSV price histories used as the price provider, with no
+    price store
+    """
+    write_histories(str(tmp_path), TICKERS)
+    monkeypatch.setenv("PRICE_PROVIDER_DIR", str(tmp_path))
+    monkeypatch.delenv("PRICE_STORE_DIR", raising=False)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def conn():
+    """
+    In-memory Redis connection
+    """
+    fakeredis = pytest.importorskip("fakeredis")
+    return fakeredis.FakeStrictRedis()
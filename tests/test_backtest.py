@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+from backtest import walk_forward
+from panel import RollingStats, return_stats
+
+
+def test_rolling_stats_match_recompute():
+    rng = np.random.default_rng(0)
+    R = rng.normal(0.0005, 0.01, (1252, 5))
+    window = 252
+    rolling = RollingStats(R[:window])
+    for day in range(window, len(R)):
+        rolling.roll(R[day], R[day - window])
+    expected = return_stats(R[-window:])
+    actual = rolling.stats()
+    for key in ["Mean", "Cov", "Corr", "Volitility"]:
+        np.testing.assert_allclose(actual[key], expected[key], rtol=1e-10, atol=1e-15)
+
+
+def test_walk_forward_holds_weights_between_rebalances():
+    rng = np.random.default_rng(0)
+    R = rng.normal(0.0005, 0.01, (130, 3))
+    dates = pd.bdate_range("2021-01-04", periods=131, name="Date")
+    prices = pd.DataFrame(
+        100 * np.exp(np.vstack([np.zeros(3), np.cumsum(R, axis=0)])),
+        index=dates,
+        columns=["AAA", "BBB", "CCC"],
+    )
+    df_equity, df_weights = walk_forward(
+        prices, window=60, rebalance=20, points=(0.0, "max_sharpe"), population=10
+    )
+    assert list(df_equity.columns) == ["0%", "max_sharpe"]
+    assert df_equity.index[0] == dates[60] and df_equity.index[-1] == dates[-1]
+    np.testing.assert_array_equal(df_equity.iloc[0], 1)
+    weights = df_weights["0%"]
+    assert list(weights.index) == list(dates[60:130:20])
+    np.testing.assert_allclose(weights.sum(axis=1), 1)
+    # buy and hold from the first rebalance to the second one
+    P = prices.to_numpy()
+    growth = P[61:81] / P[60]
+    np.testing.assert_allclose(df_equity["0%"].iloc[1:21], growth @ weights.iloc[0])
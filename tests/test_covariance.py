@@ -0,0 +1,44 @@
+import numpy as np
+
+from covariance import factor_model, ledoit_wolf
+
+
+def returns(T=60, n=8, seed=0):
+    rng = np.random.default_rng(seed)
+    market = rng.normal(0, 0.01, (T, 1))
+    return market + rng.normal(0, 0.02, (T, n)), market[:, 0]
+
+
+def test_ledoit_wolf_matches_reference():
+    R, _ = returns()
+    T, n = R.shape
+    # Ledoit and Wolf (2004), with the norm ||A||^2 = tr(A A^T) / n
+    X = R - R.mean(axis=0)
+    S = X.T @ X / T
+    m = np.trace(S) / n
+    d2 = np.sum((S - m * np.eye(n)) ** 2) / n
+    b2 = sum(np.sum((np.outer(x, x) - S) ** 2) / n for x in X) / T**2
+    expected = min(b2, d2) / d2
+    cov, shrinkage = ledoit_wolf(R)
+    np.testing.assert_allclose(shrinkage, expected)
+    np.testing.assert_allclose(cov, expected * m * np.eye(n) + (1 - expected) * S)
+    assert 0 < shrinkage < 1
+
+
+def test_factor_model_with_every_component_is_the_sample_covariance():
+    R, _ = returns()
+    cov = factor_model(R, k=R.shape[1])
+    np.testing.assert_allclose(cov.to_array(), np.cov(R.T), atol=1e-10)
+
+
+def test_factor_model_on_given_factor_matches_regression():
+    R, market = returns()
+    cov = factor_model(R, factors=market[:, None])
+    var_m = np.var(market, ddof=1)
+    beta = np.array([np.cov(market, r)[0, 1] for r in R.T]) / var_m
+    np.testing.assert_allclose(cov.B[:, 0], beta)
+    np.testing.assert_allclose(cov.diag(), np.var(R, axis=0, ddof=1))
+    dense = np.outer(beta, beta) * var_m + np.diag(cov.d)
+    np.testing.assert_allclose(cov.to_array(), dense)
+    W = np.random.default_rng(1).dirichlet(np.ones(R.shape[1]), 5)
+    np.testing.assert_allclose(cov.quad(W), np.einsum("ij,jk,ik->i", W, dense, W))
@@ -0,0 +1,103 @@
+import pickle
+
+import numpy as np
+from rq import Queue
+
+from jobs import batch_status, front_key, job_queue, load_front, save_front
+from jobs import submit_portfolio
+
+PORTFOLIO = {"AAA": 10, "BBB": 5}
+
+
+def test_submit_portfolio_reuses_identical_portfolio(conn):
+    q = Queue("default", connection=conn)
+    job = submit_portfolio(q, "optimization.process_portfolio", PORTFOLIO)
+    same = submit_portfolio(q, "optimization.process_portfolio", dict(PORTFOLIO))
+    other = submit_portfolio(
+        q, "optimization.process_portfolio", PORTFOLIO, cvar="historical"
+    )
+    assert same.id == job.id
+    assert other.id != job.id
+    assert other.kwargs == {"cvar": "historical"}
+    assert q.job_ids == [job.id, other.id]
+
+
+def test_submit_portfolio_concurrent_request_attaches(conn, monkeypatch):
+    q = Queue("default", connection=conn)
+    enqueue_job = q.enqueue_job
+    attached = []
+
+    def enqueue_after_concurrent_request(job, *args, **kwargs):
+        # a second request runs after the key is claimed, before the enqueue
+        if not attached:
+            attached.append(
+                submit_portfolio(q, "optimization.process_portfolio", PORTFOLIO)
+            )
+        return enqueue_job(job, *args, **kwargs)
+
+    monkeypatch.setattr(q, "enqueue_job", enqueue_after_concurrent_request)
+    job = submit_portfolio(q, "optimization.process_portfolio", PORTFOLIO)
+    assert attached[0].id == job.id
+    assert q.job_ids == [job.id]
+
+
+def test_submit_portfolio_replaces_failed_job(conn):
+    q = Queue("default", connection=conn)
+    job = submit_portfolio(q, "optimization.process_portfolio", PORTFOLIO)
+    job.set_status("failed")
+    retry = submit_portfolio(q, "optimization.process_portfolio", PORTFOLIO)
+    assert retry.id != job.id
+    same = submit_portfolio(q, "optimization.process_portfolio", PORTFOLIO)
+    assert same.id == retry.id
+
+
+def test_batch_status_reports_ended_and_pending_jobs(conn):
+    q = Queue("low", connection=conn)
+    failed = q.enqueue("optimization.optimize_batch_portfolio")
+    failed.set_status("failed")
+    running = q.enqueue("optimization.optimize_batch_portfolio")
+    lines = list(
+        batch_status(conn, {"a": failed.id, "b": running.id, "c": "expired-id"})
+    )
+    assert lines == [
+        {"id": "a", "status": "failed", "error": None},
+        {"id": "c", "status": "expired"},
+        {"status": "pending", "pending": 1},
+    ]
+
+
+def test_front_round_trip_in_portfolio_order(conn):
+    X = np.array([[0.2, 0.8], [0.6, 0.4]])
+    save_front(conn, PORTFOLIO, X)
+    np.testing.assert_array_equal(load_front(conn, PORTFOLIO), X)
+    # same tickers in another order: columns follow the portfolio
+    np.testing.assert_array_equal(load_front(conn, {"BBB": 1, "AAA": 1}), X[:, ::-1])
+    assert load_front(conn, {"AAA": 1, "CCC": 1}) is None
+
+
+def test_front_without_solution_is_not_stored(conn):
+    save_front(conn, PORTFOLIO, None)
+    save_front(conn, PORTFOLIO, np.empty((0, 2)))
+    assert conn.get(front_key(PORTFOLIO)) is None
+    assert load_front(conn, PORTFOLIO) is None
+
+
+def test_load_front_ignores_mismatched_sets(conn):
+    for front in [
+        {"tickers": ["AAA", "BBB"], "X": np.ones(2)},
+        {"tickers": ["AAA", "BBB"], "X": np.ones((3, 3))},
+        {"tickers": ["AAA", "BBB"], "X": np.empty((0, 2))},
+    ]:
+        conn.set(front_key(PORTFOLIO), pickle.dumps(front))
+        assert load_front(conn, PORTFOLIO) is None
+
+
+def test_job_queue_routes_by_cost():
+    assert job_queue(3) == "high"
+    assert job_queue(10) == "high"
+    assert job_queue(11) == "default"
+    assert job_queue(50) == "default"
+    assert job_queue(51) == "low"
+    # the SLSQP sweep grows faster than NSGA2 with the ticker count
+    assert job_queue(10, engine="qp") == "high"
+    assert job_queue(40, engine="qp") == "low"
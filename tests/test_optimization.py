@@ -0,0 +1,242 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pymoo.algorithms.nsga2 import NSGA2
+from pymoo.factory import get_crossover, get_mutation, get_sampling, get_termination
+from pymoo.model.problem import FunctionalProblem
+from pymoo.optimize import minimize
+from pymoo.util.nds.non_dominated_sorting import NonDominatedSorting
+
+from conftest import write_histories
+from optimization import Optimize, island_model, process_portfolio
+from optimization import getPercentChange, getStats, gethistories, getMC
+from optimization import efficient_frontier, sample_weights, warm_start_sampling
+from optimization import cvar_batch, scenario_matrix
+from optimization import prepare_universe, universe_portfolio
+from panel import PricePanel
+from results import unpack_result
+from solutions import select_solution
+
+PORTFOLIO = {"AAA": 10, "BBB": 5, "CCC": 20}
+
+
+@pytest.fixture
+def stats(price_dir):
+    frames = [close for close, _ in gethistories(PORTFOLIO)]
+    df = PricePanel.from_frames(frames).to_frame()
+    df_pct = getPercentChange(PORTFOLIO, df)
+    df_stat, Corr, Cov = getStats(PORTFOLIO, df_pct)
+    return df, df_pct, df_stat, Corr, Cov
+
+
+def test_process_portfolio(price_dir):
+    data = unpack_result(process_portfolio(PORTFOLIO))
+    assert data["portfolio"]["tickers"].tolist() == list(PORTFOLIO)
+    out = data["output"]
+    n_solutions = len(out["df_res"]["ER"])
+    assert n_solutions > 0
+    assert out["X"].shape == (n_solutions, len(PORTFOLIO))
+    # a cold run uses the full generation budget
+    assert out["n_gen"] == 1000
+    assert out["termination"] == "n_max_gen"
+    np.testing.assert_allclose(out["allocated_weights"].sum(), 1)
+    assert len(out["df_mc"]["EV"]) == 5000
+    # no price store: the histories are part of the result
+    assert sorted(data["histories"]) == ["0", "1", "2"]
+
+
+def test_stats_match_pandas(stats):
+    df, df_pct, df_stat, Corr, Cov = stats
+    expected_pct = df.pct_change().apply(lambda x: np.log(1 + x))
+    pd.testing.assert_frame_equal(df_pct, expected_pct, rtol=1e-12)
+    n = df_pct.shape[0]
+    np.testing.assert_allclose(df_stat["ER"], df_pct.mean() * n, rtol=1e-12)
+    np.testing.assert_allclose(
+        df_stat["Volitility"], df_pct.std() * np.sqrt(n), rtol=1e-12
+    )
+    np.testing.assert_allclose(Corr, df_pct.corr(), rtol=1e-12)
+    np.testing.assert_allclose(Cov, df_pct.cov() * n, rtol=1e-12)
+
+def test_island_model_front():
+    rng = np.random.default_rng(0)
+    er = rng.normal(0.1, 0.05, 4)
+    A = rng.normal(0, 0.1, (4, 4))
+    cov = A @ A.T + 0.01 * np.eye(4)
+    X = island_model(er, cov, population=20, generations=20, n_islands=2)
+    assert X.ndim == 2 and X.shape[1] == 4 and len(X) > 0
+    # feasible for the budget constraint of PortfolioProblem
+    assert np.all(np.abs(1 - X.sum(axis=1)) <= 2e-02)
+    F = np.column_stack([-X @ er, np.sqrt(np.einsum("ij,ij->i", X @ cov, X))])
+    front = NonDominatedSorting().do(F, only_non_dominated_front=True)
+    assert len(front) == len(X)
+
+
+def test_island_model_without_feasible_solution():
+    er = np.random.default_rng(0).normal(0.1, 0.05, 200)
+    cov = np.eye(200) * 0.04
+    X = island_model(er, cov, population=20, generations=5, n_islands=2)
+    assert X.shape == (0, 200)
+    df_stat = pd.DataFrame({"ER": er})
+    df_res, X = Optimize(
+        dict.fromkeys(range(200), 1),
+        df_stat,
+        cov,
+        population=20,
+        generations=5,
+        engine="islands",
+        n_islands=2,
+    )
+    assert len(df_res) == 0 and X.shape == (0, 200)
+
+
+def test_universe_portfolio_matches_own_histories(price_dir):
+    # DDD only has a month of history, it must not shorten other portfolios
+    write_histories(price_dir, ["DDD"], n_days=20, seed=1)
+    universe = prepare_universe(["AAA", "CCC", "DDD"])
+    portfolio = {"AAA": 10, "CCC": 20}
+    df, df_stat, Cov = universe_portfolio(universe, portfolio)
+    own = PricePanel.from_frames(
+        [close for close, _ in gethistories(portfolio)]
+    ).to_frame()
+    pd.testing.assert_frame_equal(df, own)
+    expected_stat, _, expected_cov = getStats(
+        portfolio, getPercentChange(portfolio, own)
+    )
+    pd.testing.assert_frame_equal(df_stat, expected_stat)
+    pd.testing.assert_frame_equal(Cov, expected_cov)
+    # histories without a common date
+    old = universe["closes"]["AAA"].iloc[:50].rename(columns={"AAA": "OLD"})
+    universe["closes"]["OLD"] = old
+    with pytest.raises(ValueError, match="common dates"):
+        universe_portfolio(universe, {"OLD": 1, "DDD": 1})
+    with pytest.raises(ValueError, match="No price history for ZZ"):
+        universe_portfolio(universe, {"AAA": 1, "ZZ": 1})
+
+
+def test_getMC_chunks_and_dtype():
+    rng = np.random.default_rng(0)
+    df_stat = pd.DataFrame({"ER": rng.normal(0.1, 0.05, 4)})
+    A = rng.normal(0, 0.1, (4, 4))
+    cov = A @ A.T
+    df_mc = getMC(range(4), None, df_stat, cov, n=1000, rng=1)
+    chunked = getMC(range(4), None, df_stat, cov, n=1000, chunk_size=300, rng=1)
+    pd.testing.assert_frame_equal(chunked, df_mc)
+    W = sample_weights(4, 1000, rng=1)
+    np.testing.assert_allclose(df_mc["ER"], W @ df_stat["ER"])
+    np.testing.assert_allclose(
+        df_mc["EV"], np.sqrt(np.einsum("ij,jk,ik->i", W, cov, W))
+    )
+    single = getMC(range(4), None, df_stat, cov, n=1000, dtype=np.float32, rng=1)
+    assert single["EV"].dtype == np.float32
+    W = sample_weights(4, 1000, rng=1, dtype=np.float32).astype(float)
+    np.testing.assert_allclose(
+        single["EV"], np.sqrt(np.einsum("ij,jk,ik->i", W, cov, W)), rtol=1e-5
+    )
+
+
+@pytest.mark.parametrize("method", ["uniform", "simplex", "dirichlet"])
+def test_sample_weights_sum_to_one(method):
+    W = sample_weights(5, 200, method=method, alpha=0.5, rng=0)
+    assert W.shape == (200, 5)
+    assert np.all(W >= 0)
+    np.testing.assert_allclose(W.sum(axis=1), 1)
+
+
+def functional_optimize(df_stat, Cov, population, generations):
+    """
+    NSGA2 on the element-wise FunctionalProblem Optimize used to build
+    """
+    n = len(df_stat)
+    problem = FunctionalProblem(
+        n,
+        [
+            lambda x: -np.sum(df_stat["ER"] * x),
+            lambda x: np.sqrt(np.dot(x.T, np.dot(Cov, x))),
+        ],
+        constr_eq=[lambda x: 1 - x.sum()],
+        constr_eq_eps=2e-02,
+        xl=np.zeros(n),
+        xu=np.ones(n),
+    )
+    algorithm = NSGA2(
+        pop_size=population,
+        n_offsprings=30,
+        sampling=get_sampling("real_random"),
+        crossover=get_crossover("real_sbx", prob=0.9, eta=15),
+        mutation=get_mutation("real_pm", eta=20),
+        eliminate_duplicates=True,
+    )
+    res = minimize(problem, algorithm, get_termination("n_gen", generations), seed=1)
+    return res.X, res.F
+
+
+def test_batch_evaluation_keeps_pareto_set(stats):
+    _, _, df_stat, _, Cov = stats
+    X_expected, F_expected = functional_optimize(df_stat, Cov, 100, 50)
+    df_res, X = Optimize(PORTFOLIO, df_stat, Cov, population=100, generations=50)
+    np.testing.assert_array_equal(X, X_expected)
+    np.testing.assert_allclose(df_res["ER"], -F_expected[:, 0], rtol=1e-12)
+    np.testing.assert_allclose(df_res["EV"], F_expected[:, 1], rtol=1e-12)
+
+
+def test_efficient_frontier():
+    rng = np.random.default_rng(0)
+    er = rng.normal(0.1, 0.05, 5)
+    A = rng.normal(0, 0.1, (5, 5))
+    cov = A @ A.T + 0.01 * np.eye(5)
+    X = efficient_frontier(er, cov, n_points=20)
+    assert np.all(X >= 0)
+    np.testing.assert_allclose(X.sum(axis=1), 1)
+    ER = X @ er
+    EV = np.sqrt(np.einsum("ij,jk,ik->i", X, cov, X))
+    assert np.all(np.diff(ER) > 0) and np.all(np.diff(EV) > 0)
+    # no random portfolio has a higher return for a lower volatility
+    W = sample_weights(5, 20000, rng=1)
+    ER_mc = W @ er
+    EV_mc = np.sqrt(np.einsum("ij,jk,ik->i", W, cov, W))
+    dominated = (ER_mc[:, None] >= ER + 1e-9) & (EV_mc[:, None] <= EV - 1e-9)
+    assert not dominated.any()
+    df_stat = pd.DataFrame({"ER": er})
+    df_res, X_qp = Optimize(dict.fromkeys("ABCDE", 1), df_stat, cov, engine="qp")
+    assert df_res.attrs["termination"] == "exact"
+    np.testing.assert_allclose(df_res["ER"], X_qp @ er)
+
+
+def test_warm_start_sampling_keeps_previous_front():
+    X0 = np.array([[0.2, 0.3, 0.5], [1.2, -0.1, 0.4]])
+    X = warm_start_sampling(X0, 10, 3)
+    assert X.shape == (10, 3)
+    np.testing.assert_array_equal(X[:2], np.clip(X0, 0, 1))
+    assert np.all((X >= 0) & (X <= 1))
+
+
+def test_adaptive_termination(stats):
+    _, _, df_stat, _, Cov = stats
+    df_res, _ = Optimize(PORTFOLIO, df_stat, Cov, termination="adaptive")
+    assert df_res.attrs["termination"] == "stagnation"
+    assert df_res.attrs["n_gen"] < 1000
+    df_res, _ = Optimize(PORTFOLIO, df_stat, Cov, termination="adaptive", max_time=0)
+    assert df_res.attrs == {"n_gen": 1, "termination": "max_time"}
+    df_res, _ = Optimize(PORTFOLIO, df_stat, Cov, generations=60)
+    assert df_res.attrs == {"n_gen": 60, "termination": "n_max_gen"}
+
+
+def test_cvar_batch_matches_sorted_losses():
+    rng = np.random.default_rng(0)
+    scenarios = rng.normal(0, 0.01, (250, 4))
+    W = sample_weights(4, 10, rng=1)
+    expected = [np.sort(-(scenarios @ w))[-13:].mean() for w in W]
+    np.testing.assert_allclose(cvar_batch(W, scenarios, 0.95), expected)
+
+
+def test_cvar_objective(stats):
+    _, df_pct, df_stat, _, Cov = stats
+    scenarios = scenario_matrix(df_pct)
+    assert len(scenarios) == len(df_pct) - 1
+    df_res, X = Optimize(
+        PORTFOLIO, df_stat, Cov, population=50, generations=20, scenarios=scenarios
+    )
+    assert list(df_res.columns) == ["ER", "EV", "SR", "CVaR"]
+    assert X.shape == (len(df_res), len(PORTFOLIO))
+    np.testing.assert_allclose(df_res["CVaR"], cvar_batch(X, scenarios))
+    assert select_solution(df_res, "min_cvar") == int(np.argmin(df_res["CVaR"]))
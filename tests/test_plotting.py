@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+from plotting import history_columns, mc_density
+from prices import to_records
+
+
+def history(n=10):
+    rng = np.random.default_rng(0)
+    close = 100 + np.cumsum(rng.normal(0, 1, n))
+    open_ = close + rng.normal(0, 1, n)
+    return pd.DataFrame(
+        {
+            "Open": open_,
+            "High": np.maximum(open_, close) + 1,
+            "Low": np.minimum(open_, close) - 1,
+            "Close": close,
+        },
+        index=pd.bdate_range("2021-01-04", periods=n, tz="UTC", name="Date"),
+    )
+
+
+def test_history_columns_downsamples_into_candles():
+    tmp = history()
+    columns = history_columns(tmp, max_points=4)
+    # candles of 3 days starting at rows 0, 3, 6 and 9
+    starts = [0, 3, 6, 9]
+    date = tmp.index.asi8[starts] / 1e6
+    np.testing.assert_array_equal(columns["all"]["date"], date)
+    np.testing.assert_array_equal(
+        columns["all"]["high"], [tmp["High"].iloc[i : i + 3].max() for i in starts]
+    )
+    np.testing.assert_array_equal(
+        columns["all"]["low"], [tmp["Low"].iloc[i : i + 3].min() for i in starts]
+    )
+    o = tmp["Open"].to_numpy()[starts]
+    c = tmp["Close"].to_numpy()[[2, 5, 8, 9]]
+    inc = o < c
+    np.testing.assert_array_equal(columns["inc"]["open"], o[inc])
+    np.testing.assert_array_equal(columns["inc"]["close"], c[inc])
+    np.testing.assert_array_equal(columns["dec"]["date"], date[~inc])
+    np.testing.assert_array_equal(columns["dec"]["close"], c[~inc])
+
+
+def test_history_columns_of_records_match_frame():
+    tmp = history()
+    from_frame = history_columns(tmp, max_points=None)
+    from_records = history_columns(to_records(tmp.assign(Volume=0)), max_points=None)
+    assert len(from_frame["all"]["date"]) == len(tmp)
+    for part in ["all", "inc", "dec"]:
+        for name, values in from_frame[part].items():
+            np.testing.assert_array_equal(from_records[part][name], values)
+
+
+def test_mc_density_counts_every_portfolio():
+    rng = np.random.default_rng(0)
+    df_mc = {"EV": rng.uniform(0.1, 0.3, 5000), "ER": rng.normal(0.1, 0.05, 5000)}
+    H, (x, y, dw, dh) = mc_density(df_mc, bins=(20, 10))
+    # ER rows, EV columns
+    assert H.shape == (10, 20)
+    assert np.nansum(H) == 5000
+    assert not np.any(H == 0)
+    expected, xedges, yedges = np.histogram2d(
+        df_mc["EV"] * 100, df_mc["ER"] * 100, bins=(20, 10)
+    )
+    np.testing.assert_array_equal(np.nan_to_num(H), expected.T)
+    np.testing.assert_allclose([x, x + dw], xedges[[0, -1]])
+    np.testing.assert_allclose([y, y + dh], yedges[[0, -1]])
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import TICKERS
+from panel import PricePanel
+from prices import CSVProvider, PriceStore, fetch_histories, format_history
+from prices import to_records
+
+START = (datetime.now() - timedelta(365)).date()
+
+
+def test_fetch_histories_reads_csv_provider(price_dir):
+    histories = fetch_histories(TICKERS, START, CSVProvider(price_dir))
+    assert len(histories) == len(TICKERS)
+    for ticker, (close, full) in zip(TICKERS, histories):
+        assert list(close.columns) == [ticker]
+        assert str(close.index.tz) == "US/Eastern"
+        assert close.index[0].date() >= START
+        expected = pd.read_csv(f"{price_dir}/{ticker}.csv", index_col="Date")
+        expected.index = pd.to_datetime(expected.index, utc=True)
+        expected = expected[expected.index >= pd.Timestamp(START, tz="UTC")]
+        np.testing.assert_array_equal(close[ticker].to_numpy(), expected["Close"])
+        np.testing.assert_array_equal(full["Open"].to_numpy(), expected["Open"])
+
+
+def test_fetch_histories_through_price_store(price_dir, tmp_path_factory):
+    provider = CSVProvider(price_dir)
+    store = PriceStore(str(tmp_path_factory.mktemp("store")))
+    direct = fetch_histories(TICKERS, START, provider)
+    # the first call fills the store, the second one reads it
+    for _ in range(2):
+        stored = fetch_histories(TICKERS, START, provider, store=store)
+        for (close, _), (expected, _) in zip(stored, direct):
+            pd.testing.assert_frame_equal(close, expected, check_freq=False)
+
+
+def test_price_store_appends_new_days(price_dir, tmp_path_factory):
+    full = CSVProvider(price_dir).history("AAA", START)
+    store = PriceStore(str(tmp_path_factory.mktemp("store")))
+    calls = []
+
+    def download_until(last, intraday=False):
+        def download(start, allow_empty):
+            calls.append(start)
+            tmp = full[full.index >= pd.Timestamp(start, tz="UTC")]
+            tmp = tmp[tmp.index <= last].copy()
+            if intraday:
+                tmp.loc[last, "Close"] *= 1.01
+            return tmp
+        return download
+
+    store.update("AAA", START, download_until(full.index[-10], intraday=True))
+    assert calls == [START]
+    assert store.load("AAA")["Close"][-1] == full["Close"].iloc[-10] * 1.01
+    # fresh enough: nothing is downloaded
+    store.update("AAA", START, download_until(full.index[-1]))
+    assert len(calls) == 1
+    store.max_age = 0
+    store.update("AAA", START, download_until(full.index[-1]))
+    # only the last stored day onwards, which replaces the intraday bar
+    assert calls[1] == full.index[-10].tz_convert("US/Eastern").date()
+    np.testing.assert_array_equal(store.load("AAA"), to_records(full))
+
+
+def test_fetch_histories_missing_ticker(price_dir):
+    with pytest.raises(FileNotFoundError):
+        fetch_histories(["AAA", "ZZ"], START, CSVProvider(price_dir), retries=0)
+    histories = fetch_histories(
+        ["AAA", "ZZ"], START, CSVProvider(price_dir), retries=0, return_exceptions=True
+    )
+    assert isinstance(histories[0], tuple)
+    assert isinstance(histories[1], FileNotFoundError)
+
+
+def test_price_panel_matches_merge(price_dir):
+    frames = [
+        format_history(ticker, CSVProvider(price_dir).history(ticker, START))[0]
+        for ticker in TICKERS
+    ]
+    merged = reduce(lambda x, y: pd.merge(x, y, on="Date"), frames)
+    panel = PricePanel.from_frames(frames).to_frame()
+    # BBB misses days, which the inner merge drops for every ticker
+    assert len(panel) < len(frames[0])
+    pd.testing.assert_frame_equal(panel, merged, check_freq=False)
@@ -0,0 +1,90 @@
+import time
+
+import numpy as np
+import pytest
+
+from results import LocalResultStore, RedisResultStore, pack_result, sizeof
+from results import unpack_result
+
+VALUE = np.zeros(100)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Time seen by the result stores, advanced by the tests
+    """
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+
+def test_local_result_store_evicts_least_recently_used():
+    store = LocalResultStore(max_bytes=int(2.5 * sizeof(VALUE)))
+    store.put("a", VALUE)
+    store.put("b", VALUE)
+    assert store.get("a") is VALUE
+    store.put("c", VALUE)
+    # b was used least recently
+    assert store.get("b") is None
+    assert store.get("a") is VALUE and store.get("c") is VALUE
+    assert store.total == 2 * sizeof(VALUE)
+    # a value above the ceiling is not kept
+    store.put("d", np.zeros(1000))
+    assert store.get("d") is None
+
+
+def test_local_result_store_expires_entries(clock):
+    store = LocalResultStore(ttl=10)
+    store.put("a", VALUE)
+    clock[0] += 5
+    assert store.get("a") is VALUE
+    clock[0] += 6
+    assert store.get("a") is None
+    assert store.total == 0
+
+
+def test_redis_result_store_evicts_least_recently_used(conn, clock):
+    store = RedisResultStore(conn, max_bytes=int(2.5 * sizeof(VALUE)))
+    store.put("a", VALUE)
+    clock[0] += 1
+    store.put("b", VALUE)
+    clock[0] += 1
+    np.testing.assert_array_equal(store.get("a"), VALUE)
+    clock[0] += 1
+    store.put("c", VALUE)
+    assert store.get("b") is None
+    assert sorted(conn.hkeys("results:sizes")) == [b"a", b"c"]
+    np.testing.assert_array_equal(store.get("c"), VALUE)
+
+
+def test_redis_result_store_forgets_expired_entries(conn, clock):
+    store = RedisResultStore(conn, ttl=10)
+    store.put("a", VALUE)
+    clock[0] += 11
+    store.put("b", VALUE)
+    assert sorted(conn.zrange("results:lru", 0, -1)) == [b"b"]
+    assert sorted(conn.hkeys("results:sizes")) == [b"b"]
+
+
+def test_pack_result_round_trip():
+    data = {
+        "portfolio": {"tickers": np.array(["AAA", "BBB"]), "n_gen": 12},
+        "output": {
+            "X": np.empty((0, 2)),
+            "df_res": {"ER": np.array([0.1, 0.2]), "SR": np.array([1.5, 0.5])},
+            "termination": "n_max_gen",
+            "missing": None,
+        },
+    }
+    # unpack_result loads without pickles
+    out = unpack_result(pack_result(data))
+    assert out["portfolio"]["tickers"].tolist() == ["AAA", "BBB"]
+    assert out["portfolio"]["n_gen"] == 12
+    assert out["output"]["termination"] == "n_max_gen"
+    # an empty front keeps its shape, None values are left out
+    assert out["output"]["X"].shape == (0, 2)
+    assert "missing" not in out["output"]
+    np.testing.assert_array_equal(out["output"]["df_res"]["ER"], [0.1, 0.2])
+    single = unpack_result(pack_result(data, dtype="float32"))
+    assert single["output"]["df_res"]["SR"].dtype == np.float32
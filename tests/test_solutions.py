@@ -0,0 +1,14 @@
+import numpy as np
+import pytest
+
+from solutions import select_solution
+
+
+def test_select_solution_bounds():
+    df_res = {"ER": np.array([0.1, 0.2]), "SR": np.array([1.0, 0.5])}
+    assert select_solution(df_res, "1") == 1
+    assert select_solution(df_res, "-1") == -1
+    assert select_solution(df_res, "max_sharpe") == 0
+    for idx in ["2", "999", "-2"]:
+        with pytest.raises(IndexError):
+            select_solution(df_res, idx)
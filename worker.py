@@ -1,4 +1,7 @@
 import os
+import signal
+import sys
+import time
 
 import redis
 from rq import Worker, Queue, Connection
@@ -9,7 +12,76 @@ redis_url = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
 
 conn = redis.from_url(redis_url)
 
+# rq workers per machine, and how many of them only take jobs from 'high' so
+# that small portfolios never wait for a large one to finish. Each worker
+# holds the preloaded stack plus a work horse per job, so size WORKERS to the
+# dyno's memory (heroku config:set WORKERS=...), not to os.cpu_count(), which
+# reports the cores of the host rather than the dyno's share.
+WORKERS = int(os.getenv('WORKERS', 2))
+HIGH_WORKERS = int(os.getenv('HIGH_WORKERS', 1 if WORKERS > 1 else 0))
+
+
+def preload():
+    """
+    Import the job modules and their heavy dependencies (pandas, scipy, pymoo,
+    yfinance) once, before forking, so workers and their work horses share them
+    """
+    import optimization  # noqa: F401
+    import backtest  # noqa: F401
+    import yfinance  # noqa: F401
+
+
+def work(queues):
+    """
+    Run one rq worker on queues with its own Redis connection
+    """
+    with Connection(redis.from_url(redis_url)):
+        worker = Worker(map(Queue, queues))
+        worker.work()
+
+
+def run(n_workers=WORKERS, n_high=HIGH_WORKERS):
+    """
+    Preload the job modules, fork n_workers rq workers (the first n_high
+    listening on 'high' only) and restart the ones that exit until stopped
+    """
+    # at least one worker takes every queue
+    n_high = min(n_high, n_workers - 1)
+    preload()
+    children = {}  # pid -> worker number
+    stopping = []
+
+    def spawn(i):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                work(['high'] if i < n_high else listen)
+            finally:
+                os._exit(0)
+        children[pid] = i
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for i in range(n_workers):
+        spawn(i)
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        i = children.pop(pid, None)
+        if i is not None and not stopping:
+            # do not spin if a worker keeps dying (e.g. Redis is down)
+            time.sleep(1)
+            spawn(i)
+
+
 if __name__ == '__main__':
-    with Connection(conn):
-        worker = Worker(map(Queue, listen))
-        worker.work()
\ No newline at end of file
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else WORKERS)